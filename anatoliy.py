@@ -1,51 +1,148 @@
+import asyncio
+import fcntl
+import gzip
+import heapq
+import importlib
 import json
 import logging
 import os
+import re
+import time
 from datetime import datetime
 
 from dotenv import load_dotenv
 from starlette.applications import Starlette
+from starlette.middleware import Middleware
 from starlette.requests import Request
-from starlette.responses import JSONResponse, Response, PlainTextResponse
+from starlette.responses import JSONResponse, Response, PlainTextResponse, StreamingResponse
 from starlette.routing import Route
 from starlette.staticfiles import StaticFiles
-from PIL import Image, ImageDraw, ImageFont
-import io
-import hashlib
-from telegram import (
-    InlineKeyboardMarkup,
-    KeyboardButton,
-    Update,
-    InlineKeyboardButton,
-    ReplyKeyboardMarkup,
+from starlette.concurrency import run_in_threadpool
+from devices import DeviceMiddleware, DeviceRegistry, next_poll_after
+from execution import ExecutionLayer, Overloaded
+from framestore import FRAME_HASH, FrameStore, StoredFrame
+from metrics import MetricsMiddleware, Registry
+from retention import RETENTION_MODES, append_to_pack, read_from_pack, read_pack_index, select_expired
+from storage import Storage
+from render import (
+    DeviceProfile,
+    LRUCache,
+    RenderedFrame,
+    frame_diff,
+    load_frame,
+    load_frame_meta,
+    render_and_save,
+    render_thumbnail,
 )
-from telegram.ext import (
-    Application,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    filters,
-    ContextTypes,
-    ConversationHandler,
-)
-
-WIFI_NAME, WIFI_PASSWORD = range(2)
 
-# Global cache for last image MD5
-last_md5_file = None
-last_md5 = None
+# Latest-image index: the newest .jpg files in IMAGE_DIR (newest first), the
+# newest one's mtime, and the directory mtime they were read at
+latest_images = []
+latest_image_mtime = 0
+latest_image_dir_mtime = None
+
+# The Wi-Fi book as last loaded by this worker (see load_wifi_book)
+wifi_book = None
+
+# Set (and replaced) whenever a new frame becomes the latest one, waking all
+# long-poll and SSE requests of this worker at once, and the hash of the new
+# frame per profile name, looked up once for all of them
+new_frame_event = asyncio.Event()
+current_md5s = {}
+frame_watch_task = None
+loop_lag_task = None
+retention_task = None
+device_flush_task = None
+
+# The bot module (bot.py), once this worker runs the bot, and the lock that
+# makes it the only one
+bot = None
+bot_lock = None
+bot_claim_task = None
 
 # Load environment variables
 load_dotenv()
-TOKEN = os.getenv("TOKEN")
-DOMAIN_NAME = os.getenv("DOMAIN_NAME")
 
-# Texts from .env
-WELCOME_TEXT = os.getenv("WELCOME_TEXT", "Welcome! Your user ID has been registered.")
-NOTIFY_PROMPT = os.getenv("NOTIFY_PROMPT", "Do you want to notify all users about this upload?")
-UPDATE_TEXT = os.getenv("UPDATE_TEXT", "A new image has been uploaded!")
-WIFI_CONNECT_TEXT = os.getenv("WIFI_CONNECT_TEXT", "Thank you for sharing your network!")
-ABOUT_TEXT = os.getenv("ABOUT_TEXT")
+# Telegram bot (see bot.py): "webhook" runs it in one worker of this app,
+# "polling" in a separate `python bot.py` process, "off" not at all
+BOT_MODE = os.getenv("BOT_MODE", "webhook")
+# How often a worker without the bot retries taking it over (seconds)
+BOT_CLAIM_INTERVAL = float(os.getenv("BOT_CLAIM_INTERVAL", "5"))
+
+# How long a reverse proxy may serve a frame without revalidating (seconds)
+FRAME_CACHE_MAX_AGE = int(os.getenv("FRAME_CACHE_MAX_AGE", "5"))
+
+# Rendering: resampling filter for the downscale (see render.RESAMPLING) and how
+# uploads are fitted to the panel (stretch, crop or fit, see render.FIT_MODES).
+# These are the defaults for every device profile.
+RENDER_RESAMPLE = os.getenv("RENDER_RESAMPLE", "lanczos")
+RENDER_FIT = os.getenv("RENDER_FIT", "stretch")
+
+# Device profiles (see load_device_profiles)
+DEVICE_PROFILES_FILE = os.getenv("DEVICE_PROFILES_FILE", "./profiles.json")
+
+# Frame store shared by the workers (see framestore.FrameStore): how many frame
+# files are kept, and how many each worker keeps mapped
+FRAME_STORE_MAX_FRAMES = int(os.getenv("FRAME_STORE_MAX_FRAMES", "1024"))
+FRAME_STORE_MAPPED = int(os.getenv("FRAME_STORE_MAPPED", "256"))
+
+# Frame diffs: how many recently served frames per profile are remembered as
+# diff bases besides the frame store, and the largest diff worth sending, as a
+# share of the full binary frame
+FRAME_HISTORY = int(os.getenv("FRAME_HISTORY", "8"))
+FRAME_DIFF_MAX_RATIO = float(os.getenv("FRAME_DIFF_MAX_RATIO", "0.5"))
+
+# Rotation: devices cycle through the newest ROTATION_SIZE memes (1 shows only
+# the newest), showing each for ROTATION_INTERVAL seconds
+ROTATION_SIZE = int(os.getenv("ROTATION_SIZE", "1"))
+ROTATION_INTERVAL = float(os.getenv("ROTATION_INTERVAL", "900"))
+
+# Archive: thumbnail size (px, longer side) and listing page sizes
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "240"))
+ARCHIVE_PAGE_SIZE = int(os.getenv("ARCHIVE_PAGE_SIZE", "20"))
+ARCHIVE_MAX_PAGE_SIZE = int(os.getenv("ARCHIVE_MAX_PAGE_SIZE", "100"))
+
+# Retention: originals of uploads beyond any of these limits (0 = no limit) are
+# moved into the pack file (RETENTION_MODE=pack) or deleted (delete). Their
+# rendered frames and thumbnails are kept. Checked every RETENTION_INTERVAL seconds.
+RETENTION_MAX_AGE_DAYS = float(os.getenv("RETENTION_MAX_AGE_DAYS", "0"))
+RETENTION_MAX_COUNT = int(os.getenv("RETENTION_MAX_COUNT", "0"))
+RETENTION_MAX_BYTES = int(os.getenv("RETENTION_MAX_BYTES", "0"))
+RETENTION_MODE = os.getenv("RETENTION_MODE", "pack")
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+if RETENTION_MODE not in RETENTION_MODES:
+    raise ValueError(f"Unknown RETENTION_MODE {RETENTION_MODE!r}, expected one of {', '.join(RETENTION_MODES)}")
+
+# Devices: the headers they identify themselves with, how many are tracked, and
+# how often their last-seen times, firmware versions and frame hashes are saved
+DEVICE_HEADER = "X-Device-Id"
+FIRMWARE_HEADER = "X-Firmware-Version"
+MAX_DEVICES = int(os.getenv("MAX_DEVICES", "1000"))
+DEVICE_FLUSH_INTERVAL = float(os.getenv("DEVICE_FLUSH_INTERVAL", "30"))
+
+# Poll hints sent to devices as X-Next-Poll-After (see devices.next_poll_after):
+# from POLL_MIN_INTERVAL seconds right after an upload, growing by
+# POLL_ACTIVITY_RATIO of the time since, up to POLL_MAX_INTERVAL; spread by
+# +-POLL_JITTER
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "10"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "300"))
+POLL_ACTIVITY_RATIO = float(os.getenv("POLL_ACTIVITY_RATIO", "0.1"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.2"))
+
+# Execution layer: render processes and I/O threads per gunicorn worker (0 render
+# processes renders in the I/O threads), and how many renders may be pending at once
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "1"))
+IO_WORKERS = int(os.getenv("IO_WORKERS", "8"))
+MAX_PENDING_JOBS = int(os.getenv("MAX_PENDING_JOBS", "64"))
+
+# Long-poll / SSE settings (seconds)
+LONG_POLL_TIMEOUT = float(os.getenv("LONG_POLL_TIMEOUT", "30"))
+LONG_POLL_MAX_TIMEOUT = float(os.getenv("LONG_POLL_MAX_TIMEOUT", "120"))
+SSE_KEEPALIVE = float(os.getenv("SSE_KEEPALIVE", "15"))
+# How often each worker checks IMAGE_DIR for uploads handled by other workers
+FRAME_WATCH_INTERVAL = float(os.getenv("FRAME_WATCH_INTERVAL", "1"))
+# How often the event-loop lag is sampled for /metrics (seconds)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "1"))
 
 # Enable logging
 logging.basicConfig(
@@ -60,116 +157,138 @@ os.makedirs(IMAGE_DIR, exist_ok=True)
 
 USER_DATA_DIR = "./users"
 os.makedirs(USER_DATA_DIR, exist_ok=True)
+DB_FILE = os.getenv("DB_FILE", os.path.join(USER_DATA_DIR, "anatoliy.db"))
+# Legacy JSON storage, imported into the database once
 USER_DATA_FILE = os.path.join(USER_DATA_DIR, "user_data.json")
 NETWORKS_FILE = os.path.join(USER_DATA_DIR, "networks.json")
+# Held by the one process running the bot
+BOT_LOCK_FILE = os.path.join(USER_DATA_DIR, "bot.lock")
+# Retired originals (RETENTION_MODE=pack), and the lock held during a retention pass
+PACK_FILE = os.path.join(USER_DATA_DIR, "originals.pack")
+RETENTION_LOCK_FILE = os.path.join(USER_DATA_DIR, "retention.lock")
+
+# Pre-rendered device frames, one sub-directory per uploaded image
+RENDER_DIR = "./rendered"
+os.makedirs(RENDER_DIR, exist_ok=True)
+
+# Rendered frames, one memory-mapped file per frame hash, shared by all workers
+# (on a tmpfs such as /dev/shm, if FRAME_STORE_DIR points there)
+FRAME_STORE_DIR = os.getenv("FRAME_STORE_DIR", os.path.join(RENDER_DIR, ".frames"))
+frame_store = FrameStore(FRAME_STORE_DIR, FRAME_STORE_MAPPED, FRAME_STORE_MAX_FRAMES)
+# Frame hashes, keyed by ((path, mtime, size), profile name)
+md5_cache = LRUCache(1024)
+
+# Pools that keep Pillow and disk work off the event loop, started in on_startup
+executor = ExecutionLayer(RENDER_WORKERS, IO_WORKERS, MAX_PENDING_JOBS)
+
+# Metrics served on /metrics, per worker process
+metrics = Registry()
+http_requests = metrics.counter(
+    "anatoliy_http_requests_total", "HTTP requests by route and status.", ("route", "status")
+)
+http_latency = metrics.histogram(
+    "anatoliy_http_request_duration_seconds", "HTTP request latency by route.", ("route",)
+)
+render_seconds = metrics.histogram(
+    "anatoliy_render_stage_seconds", "Time spent per rendering stage.", ("stage", "profile")
+)
+loop_lag = metrics.histogram(
+    "anatoliy_event_loop_lag_seconds", "How late the event loop wakes up from a timer."
+)
+# Devices seen by this worker, saved to the database every DEVICE_FLUSH_INTERVAL
+device_registry = DeviceRegistry(MAX_DEVICES)
+metrics.gauge(
+    "anatoliy_device_last_seen_timestamp_seconds",
+    "Unix time of the last request from each device (X-Device-Id).",
+    ("device",),
+    collect=device_registry.last_seen,
+)
+metrics.counter(
+    "anatoliy_cache_hits_total", "Cache lookups that found an entry.", ("cache",),
+    collect=lambda: {("frame",): frame_store.mapped.hits, ("md5",): md5_cache.hits},
+)
+metrics.counter(
+    "anatoliy_cache_misses_total", "Cache lookups that found nothing.", ("cache",),
+    collect=lambda: {("frame",): frame_store.mapped.misses, ("md5",): md5_cache.misses},
+)
+metrics.gauge(
+    "anatoliy_cache_hit_ratio", "Share of cache lookups that found an entry.", ("cache",),
+    collect=lambda: {
+        (name,): cache.hits / max(1, cache.hits + cache.misses)
+        for name, cache in (("frame", frame_store.mapped), ("md5", md5_cache))
+    },
+)
+metrics.gauge(
+    "anatoliy_frame_store_mapped_bytes", "Size of the frame files this worker maps (pages shared by all workers).",
+    collect=lambda: {(): sum(frame.size for frame in list(frame_store.mapped.entries.values()))},
+)
+metrics.gauge(
+    "anatoliy_pending_jobs", "Render jobs queued or running.",
+    collect=lambda: {(): executor.pending},
+)
+retired_images = metrics.counter(
+    "anatoliy_retired_images_total", "Originals packed or deleted by retention.", ("mode",)
+)
+metrics.gauge(
+    "anatoliy_broadcast_queue_depth", "Notifications waiting to be broadcast.",
+    collect=lambda: {
+        (): bot.broadcaster.queue_depth if bot is not None and bot.broadcaster is not None else 0
+    },
+)
 
-# Create an empty JSON file for user data if it doesn't exist
-if not os.path.exists(USER_DATA_FILE):
-    with open(USER_DATA_FILE, "w") as file:
-        json.dump([], file)
-
-# Initialize the Telegram bot application
-application = Application.builder().token(TOKEN).build()
-
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /start command and register the user, then show the main menu."""
-    user_id = update.effective_user.id
-    register_user(user_id)
-    await update.message.reply_text(WELCOME_TEXT)
-    await show_main_menu(update, context)  # Show the main menu after welcome
-
+# Open the database (users, Wi-Fi networks, images) and import the JSON files once
+storage = Storage(DB_FILE)
+storage.import_json(USER_DATA_FILE, NETWORKS_FILE)
 
-async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+def try_bot_lock():
     """
-    Handle photo uploads.
-    After saving the photo, prompt the user to notify all other users.
+    Take the bot lock, making this process the only one running the bot.
+    Returns the open lock file (keep it open), or None if another process
+    holds it. The lock is released when the process exits.
     """
-    user = update.effective_user
-    photo = update.message.photo[-1]
-    caption = update.message.caption or "image"
-
-    # Build the filename: yy-mm-dd-hh-mm-ss-username-img_name.jpg
-    now_str = datetime.now().strftime("%y-%m-%d-%H-%M-%S")
-    username_str = user.username if user.username else str(user.id)
-    sanitized_caption = caption.replace(" ", "_")
-    filename = f"{now_str}-{username_str}-{sanitized_caption}.jpg"
-    file_path = os.path.join(IMAGE_DIR, filename)
-
-    # Download the file
-    file_obj = await context.bot.get_file(photo.file_id)
-    await file_obj.download_to_drive(file_path)
-
-    # Prompt user whether to notify everyone
-    keyboard = [
-        [
-            InlineKeyboardButton("Давай", callback_data="notify_yes"),
-            InlineKeyboardButton("Ну не", callback_data="notify_no"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return try_file_lock(BOT_LOCK_FILE)
 
-    # Send the notification prompt
-    await update.message.reply_text(NOTIFY_PROMPT, reply_markup=reply_markup)
 
+def try_file_lock(path: str):
+    """Take an exclusive lock on `path` without waiting. Returns the open file, or None."""
+    lock = open(path, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    return lock
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle all button presses (InlineKeyboardButton callbacks)."""
-    query = update.callback_query
-    await query.answer()
-
-    if query.data == "upload_image":
-        await query.message.reply_text("Просто загрузи картинку.")
-
-    elif query.data == "notify_yes":
-        # Delete the original message with buttons
-        await query.message.delete()
 
-        # Broadcast the update text to all users
-        user_ids = get_all_user_ids()
-        for user_id in user_ids:
+async def claim_bot() -> None:
+    """
+    BOT_MODE=webhook: start the bot in this worker once it gets the bot lock.
+    The other workers keep retrying, so the bot moves to another worker when
+    its worker exits. Telegram is only imported by the worker that gets it.
+    """
+    global bot, bot_lock
+    while True:
+        lock = try_bot_lock()
+        if lock is not None:
             try:
-                await context.bot.send_message(chat_id=user_id, text=UPDATE_TEXT)
+                module = importlib.import_module("bot")
+                await module.start_webhook()
             except Exception as e:
-                logger.error(f"Failed to send notification to {user_id}: {e}")
-
-    elif query.data == "notify_no":
-        # Delete the original message with buttons
-        await query.message.delete()
-        # Optionally respond with a "not notified" text
-
-    # (share_wifi is handled by the ConversationHandler)
-
-
-async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle plain text messages (non-photo, non-command)."""
-    user_text = update.message.text
-    logger.info(f"User sent text message: {user_text}")
-    await update.message.reply_text(f"You said: {user_text}")
-
-
-def register_user(user_id: int) -> None:
-    """Register a new user by adding their user ID to the JSON file."""
-    with open(USER_DATA_FILE, "r") as file:
-        user_ids = json.load(file)
-    if user_id not in user_ids:
-        user_ids.append(user_id)
-        with open(USER_DATA_FILE, "w") as file:
-            json.dump(user_ids, file)
-        logger.info(f"Registered new user: {user_id}")
-    else:
-        logger.info(f"User {user_id} is already registered.")
-
-
-def get_all_user_ids() -> list:
-    """Retrieve all registered user IDs from the JSON file."""
-    with open(USER_DATA_FILE, "r") as file:
-        user_ids = json.load(file)
-    return user_ids
+                logger.error(f"Failed to start the bot: {e}")
+                lock.close()
+            else:
+                bot, bot_lock = module, lock
+                logger.info(f"Worker {os.getpid()} runs the Telegram bot")
+                return
+        await asyncio.sleep(BOT_CLAIM_INTERVAL)
 
 
 async def telegram_webhook(request: Request) -> PlainTextResponse:
-    """Webhook endpoint for Telegram updates."""
+    """
+    Webhook endpoint for Telegram updates. The worker running the bot queues
+    them for processing; any other worker stores them for that worker to pick
+    up. Either way Telegram gets its answer right away.
+    """
     try:
         data = await request.json()
         logger.debug(f"Incoming update: {data}")
@@ -177,120 +296,436 @@ async def telegram_webhook(request: Request) -> PlainTextResponse:
         logger.error(f"Failed to parse incoming update: {e}")
         return PlainTextResponse("Error parsing JSON", status_code=400)
 
-    update = Update.de_json(data, application.bot)
-    await application.process_update(update)
+    if bot is not None:
+        bot.enqueue_update(data)
+        return PlainTextResponse("OK")
+    try:
+        await run_in_threadpool(storage.add_update, json.dumps(data))
+    except Exception as e:
+        # Telegram retries the update later
+        logger.error(f"Failed to store incoming update: {e}")
+        return PlainTextResponse("Error storing update", status_code=500)
     return PlainTextResponse("OK")
 
 
 #
-# 1. Helper function: parse the username from the filename
+# 1. Helper function: parse the upload's metadata from the filename
 #
-def parse_username_from_filename(image_path: str) -> str:
-    """
-    Example: "23-09-26-10-15-45-someUser-FunnyCaption.jpg"
-    splits = ["23", "09", "26", "10", "15", "45", "someUser", "FunnyCaption.jpg"]
-    We'll assume index 6 is the username in that scenario.
+# Uploads are saved as yy-mm-dd-hh-mm-ss-username-caption.jpg (see bot.py)
+IMAGE_FILENAME = re.compile(r"^(\d{2}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})-([^-]+)-(.*)\.jpg$")
 
-    If your format is strictly: yymmdd-hhmmss-username-caption.jpg
-    then splitted[1] is the username. Adjust accordingly if needed.
+
+def parse_image_filename(filename: str) -> dict:
     """
-    filename = os.path.basename(image_path)
-    splitted = filename.split("-")
-
-    # Adjust based on how many dashes you have in your filename
-    # If your format is: f"{now_str}-{username_str}-{sanitized_caption}.jpg"
-    # then splitted = [ 'yy-mm-dd-hh-mm-ss', 'username', 'caption.jpg' ]
-    # splitted[1] should be the username
-    if len(splitted) > 1:
-        return splitted[6]
+    Uploader, caption and upload time of an image, from its filename. For
+    files named differently (copied in by hand) the username is "UnknownUser"
+    and the time is the file's mtime, if it exists.
+    """
+    match = IMAGE_FILENAME.match(filename)
+    if match is not None:
+        uploaded_at = datetime.strptime(match.group(1), "%y-%m-%d-%H-%M-%S")
+        username, caption = match.group(2), match.group(3).replace("_", " ")
     else:
-        return "UnknownUser"
+        path = os.path.join(IMAGE_DIR, filename)
+        uploaded_at = datetime.fromtimestamp(os.path.getmtime(path)) if os.path.exists(path) else datetime.now()
+        username, caption = "UnknownUser", os.path.splitext(filename)[0]
+    return {
+        "filename": filename,
+        "username": username,
+        "caption": caption,
+        "uploaded_at": uploaded_at.isoformat(timespec="seconds"),
+    }
+
+
+def image_label(image_path: str) -> dict:
+    """
+    The watermark fields of an image (see render.WATERMARK_FIELDS), from the
+    catalog (filenames are only parsed once, when cataloged).
+    """
+    filename = os.path.basename(image_path)
+    image = storage.get_image_by_filename(filename)
+    if image is None:
+        image = parse_image_filename(filename)
+    return {"username": image["username"], "caption": image["caption"], "date": image["uploaded_at"][:10]}
 
 
 #
-# Draw the username in the lower-left corner with a black box behind it
+# 2. Latest-image index, so the hot routes don't list and sort IMAGE_DIR
 #
-def draw_username(img: Image.Image, username: str) -> None:
-    draw = ImageDraw.Draw(img)
-    font = ImageFont.load_default()
+def scan_recent_images(count: int) -> list:
+    """The `count` newest .jpg files in IMAGE_DIR as (mtime_ns, path), newest first."""
+    with os.scandir(IMAGE_DIR) as entries:
+        images = [
+            (entry.stat().st_mtime_ns, os.path.join(IMAGE_DIR, entry.name))
+            for entry in entries
+            if entry.name.endswith(".jpg") and entry.is_file()
+        ]
+    return heapq.nlargest(count, images)
 
-    # Fallback approach: use getmask() -> getbbox()
-    mask = font.getmask(username)
-    bbox = mask.getbbox()  # (x0, y0, x1, y1)
 
-    if bbox:
-        text_width = bbox[2] - bbox[0]
-        text_height = bbox[3] - bbox[1]
-    else:
-        # In case getbbox() returns None, fallback to something small
-        text_width, text_height = (0, 0)
+def get_latest_images() -> list:
+    """
+    Return the newest images (up to ROTATION_SIZE) from the index, newest
+    first. A single stat() of IMAGE_DIR per call detects files added or
+    removed outside this process (other workers, manual copies); only then is
+    the directory rescanned.
+    """
+    global latest_images, latest_image_mtime, latest_image_dir_mtime
+    dir_mtime = os.stat(IMAGE_DIR).st_mtime_ns
+    if dir_mtime != latest_image_dir_mtime:
+        recent = scan_recent_images(max(1, ROTATION_SIZE))
+        latest_images = [path for _, path in recent]
+        latest_image_mtime = recent[0][0] if recent else 0
+        latest_image_dir_mtime = dir_mtime
+        logger.info(f"Latest image index refreshed: {latest_images[0] if latest_images else None}")
+    return latest_images
+
+
+def set_latest_image(image_path: str) -> None:
+    """Put a freshly saved upload at the front of the index without rescanning."""
+    global latest_images, latest_image_mtime, latest_image_dir_mtime
+    latest_images = [image_path, *(path for path in latest_images if path != image_path)]
+    del latest_images[max(1, ROTATION_SIZE):]
+    latest_image_mtime = os.stat(image_path).st_mtime_ns
+    latest_image_dir_mtime = os.stat(IMAGE_DIR).st_mtime_ns
+
+
+def rotation_position(now: float | None = None) -> tuple:
+    """
+    Which of the latest images is served now, and seconds until the next one.
+    With ROTATION_SIZE > 1 devices cycle through the newest ROTATION_SIZE
+    images, one every ROTATION_INTERVAL seconds. The clock starts at the newest
+    upload, so a new meme is shown at once, and since it only depends on file
+    mtimes all workers agree without talking to each other.
+    """
+    return rotation_slot(len(get_latest_images()), now)
 
-    # Position the text in the lower-left corner
-    # 2 pixels from the left and 2 pixels from the bottom
-    x = 1
-    y = img.height - text_height - 2
 
-    # Draw a black rectangle to serve as background for the white text
-    # Expand it by 1 pixel on all sides if you want some padding around the text
-    rect_x1 = x - 1
-    rect_y1 = y - 1
-    rect_x2 = x + text_width + 2
-    rect_y2 = y + text_height + 1
+def rotation_slot(count: int, now: float | None = None) -> tuple:
+    """rotation_position for `count` latest images, from the index as it is (no stat())."""
+    if ROTATION_SIZE <= 1 or count <= 1:
+        return 0, None
+    elapsed = max(0.0, (now or time.time()) - latest_image_mtime / 1e9)
+    slot = int(elapsed // ROTATION_INTERVAL)
+    return slot % count, ROTATION_INTERVAL * (slot + 1) - elapsed
 
-    draw.rectangle((rect_x1, rect_y1, rect_x2, rect_y2), fill=1)
 
-    # Now draw the white text on top
-    draw.text((x, y), username, fill=0, font=font)
+def current_image() -> str | None:
+    """The image currently served to devices (see rotation_position), or None."""
+    images = get_latest_images()
+    if not images:
+        return None
+    position, _ = rotation_position()
+    return images[position]
 
 
 #
-# 3. The /get_last_img route
+# 3. Render pipeline: render once per upload, then serve the stored artifacts
 #
-async def get_last_img(request: Request) -> Response:
-    """Serve the latest uploaded image as a 256x122 black & white JPEG, watermarked."""
+def load_device_profiles(path: str) -> tuple:
+    """
+    Load device profiles from a JSON file like:
+
+        {
+            "profiles": {"kitchen": {"width": 296, "height": 128, "rotation": 180,
+                                     "dither": "atkinson", "watermark": false}},
+            "devices": {"<X-Device-Id>": "kitchen"}
+        }
+
+    Profile fields are those of render.DeviceProfile. The "default" profile is
+    always there (the 256x122 Heltec panel) and may be overridden.
+    Returns ({name: DeviceProfile}, {device id: profile name}).
+    """
+    defaults = {"resample": RENDER_RESAMPLE, "fit": RENDER_FIT}
+    profiles = {"default": DeviceProfile("default", **defaults)}
+    devices = {}
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            config = json.load(file)
+        for name, settings in config.get("profiles", {}).items():
+            profiles[name] = DeviceProfile(name, **{**defaults, **settings})
+        devices = config.get("devices", {})
+        unknown = set(devices.values()) - profiles.keys()
+        if unknown:
+            raise ValueError(f"Devices mapped to unknown profiles: {', '.join(sorted(unknown))}")
+        logger.info(f"Loaded device profiles: {', '.join(profiles)}")
+    return profiles, devices
+
+
+DEVICE_PROFILES, DEVICE_PROFILE_MAP = load_device_profiles(DEVICE_PROFILES_FILE)
+DEFAULT_PROFILE = DEVICE_PROFILES["default"]
+
+# Diffs between frames, keyed by (profile name, base md5, md5); b"" marks "send
+# the full frame"
+diff_cache = LRUCache(256)
+# The upload each recently looked-up frame was rendered from, keyed by (profile
+# name, md5), so diff bases are found without listing IMAGE_DIR
+frame_sources = LRUCache(max(FRAME_HISTORY, ROTATION_SIZE) * len(DEVICE_PROFILES))
+
+
+def profile_for(request: Request) -> DeviceProfile | None:
+    """
+    The profile a request is rendered for: `?profile=<name>`, else the profile
+    mapped to its X-Device-Id header, else "default". None if the name is unknown.
+    """
+    name = request.query_params.get("profile")
+    if name is None:
+        name = DEVICE_PROFILE_MAP.get(request.headers.get(DEVICE_HEADER, ""), "default")
+    return DEVICE_PROFILES.get(name)
+
+
+def frame_dir_for(image_path: str, profile: DeviceProfile) -> str:
+    """Directory holding the artifacts of an uploaded image rendered for `profile`."""
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(RENDER_DIR, stem, profile.name)
+
+
+def retired_source_path_for(image_path: str) -> str:
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(RENDER_DIR, stem, "source.json")
+
+
+def source_key(image_path: str) -> tuple:
+    """
+    Identity of an upload: a file replaced under the same name gets a new key.
+    Once retention removed the original, the identity it recorded then (see
+    retire_original), so the frames rendered before still load.
+    """
     try:
-        # Sort by modification time (newest first)
-        image_files = sorted(
-            (
-                os.path.join(IMAGE_DIR, f)
-                for f in os.listdir(IMAGE_DIR)
-                if f.endswith(".jpg")
-            ),
-            key=os.path.getmtime,
-            reverse=True,
+        stat = os.stat(image_path)
+    except FileNotFoundError:
+        retired_source_path = retired_source_path_for(image_path)
+        if not os.path.exists(retired_source_path):
+            raise
+        with open(retired_source_path, "r") as file:
+            source = json.load(file)
+        return (image_path, source["mtime_ns"], source["size"])
+    return (image_path, stat.st_mtime_ns, stat.st_size)
+
+
+def source_stamp(key: tuple, profile: DeviceProfile) -> dict:
+    """
+    The part of a source key stored next to the artifacts in meta.json, with
+    the profile settings: changing a profile re-renders its stored frames.
+    """
+    return {"mtime_ns": key[1], "size": key[2], "profile": profile.settings()}
+
+
+def find_frame(image_path: str, profile: DeviceProfile) -> tuple:
+    """
+    Blocking lookup of an already rendered frame: from the frame store, by the
+    hash recorded for the upload, else from the upload's stored artifacts
+    (which are then added to the store). Returns (source key, frame or None);
+    never renders.
+    """
+    key, md5 = find_frame_md5(image_path, profile)
+    if md5 is None:
+        return key, None
+    frame = frame_store.get(md5)
+    if frame is None:
+        rendered = load_frame(frame_dir_for(image_path, profile), source_stamp(key, profile))
+        if rendered is None:
+            return key, None
+        frame = frame_store.put(rendered)
+    return key, frame
+
+
+def find_frame_md5(image_path: str, profile: DeviceProfile) -> tuple:
+    """
+    Blocking lookup of the hash of the frame served for an image. Cached in
+    memory by (path, mtime, size); the on-disk meta.json sidecar shares it
+    between gunicorn workers, so a worker only reads that small file, never
+    the upload itself. Returns (source key, md5 or None if not rendered yet).
+    """
+    key = source_key(image_path)
+    md5 = md5_cache.get((key, profile.name))
+    if md5 is None:
+        meta = load_frame_meta(frame_dir_for(image_path, profile), source_stamp(key, profile))
+        if meta is None:
+            return key, None
+        md5 = meta["md5"]
+        md5_cache.put((key, profile.name), md5)
+    frame_sources.put((profile.name, md5), image_path)
+    return key, md5
+
+
+async def get_rendered_frame(image_path: str, profile: DeviceProfile = DEFAULT_PROFILE) -> StoredFrame:
+    """
+    Return the frame for an image rendered for `profile`, and only render it
+    if it has never been rendered before (e.g. images copied into IMAGE_DIR by
+    hand) or the upload or profile changed since. Lookups run in the I/O
+    threads, renders in the render processes; concurrent requests for the same
+    upload and profile share one render, also across workers (see
+    render.render_and_save). The frame is served from the frame store.
+    """
+    key, frame = await executor.run_io(find_frame, image_path, profile)
+    if frame is None:
+        label = await executor.run_io(image_label, image_path)
+
+        def rendered(frame: RenderedFrame) -> None:
+            # Once per render, however many requests waited for it
+            md5_cache.put((key, profile.name), frame.md5)
+            frame_sources.put((profile.name, frame.md5), image_path)
+            for stage, seconds in frame.timings.items():
+                render_seconds.observe(seconds, stage, profile.name)
+            logger.info(f"Rendered frame {frame.md5} ({profile.name}) for {image_path}")
+
+        frame = await executor.run_render(
+            (key, profile.name),
+            render_and_save,
+            image_path,
+            label,
+            frame_dir_for(image_path, profile),
+            source_stamp(key, profile),
+            profile,
+            on_done=rendered,
+            then=frame_store.put,
         )
+    return frame
 
-        if not image_files:
-            return JSONResponse({"error": "No images found."}, status_code=404)
 
-        latest_image_path = image_files[0]
-        username = parse_username_from_filename(latest_image_path)
+async def get_latest_frame(profile: DeviceProfile) -> StoredFrame | None:
+    """The frame currently served to devices with `profile`, or None if there are no images."""
+    image_path = await executor.run_io(current_image)
+    if image_path is None:
+        return None
+    return await get_rendered_frame(image_path, profile)
 
-        # Open with Pillow
-        img = Image.open(latest_image_path)
 
-        # Resize to 256x122 (unproportional)
-        img = img.resize((256, 122), Image.Resampling.NEAREST)
+def find_recent_frame(md5: str, profile: DeviceProfile) -> StoredFrame | None:
+    """
+    Blocking lookup of a frame by hash: from the frame store, else from the
+    stored artifacts of the upload it was rendered from, if it is one of the
+    frames this worker looked up recently (for frames pruned from the store).
+    None if not found or not a hash; never lists IMAGE_DIR, whatever is asked for.
+    """
+    if not FRAME_HASH.fullmatch(md5):
+        return None
+    frame = frame_store.get(md5)
+    if frame is not None:
+        return frame
+    image_path = frame_sources.get((profile.name, md5))
+    if image_path is None:
+        return None
+    _, frame = find_frame(image_path, profile)
+    return frame if frame is not None and frame.md5 == md5 else None
+
+
+async def current_frame_md5(profile: DeviceProfile) -> str | None:
+    """Hash of the frame currently served to devices with `profile`, or None."""
+    image_path = await executor.run_io(current_image)
+    if image_path is None:
+        return None
+    _, md5 = await executor.run_io(find_frame_md5, image_path, profile)
+    if md5 is None:
+        md5 = (await get_rendered_frame(image_path, profile)).md5
+    return md5
+
+
+def unknown_profile_response() -> Response:
+    return JSONResponse({"error": "Unknown profile."}, status_code=400)
+
+
+def overloaded_response() -> Response:
+    """503 telling the client to come back shortly, when too many renders are pending."""
+    return JSONResponse({"error": "Server busy."}, status_code=503, headers={"Retry-After": "1"})
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against our ETag (RFC 9110)."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def accepts_gzip(request: Request) -> bool:
+    """
+    Whether the request's Accept-Encoding allows gzip: listed (or matched by
+    "*") with a q-value above 0, so "gzip;q=0" refuses it (RFC 9110).
+    """
+    qualities = {}
+    for item in request.headers.get("accept-encoding", "").split(","):
+        coding, *params = item.split(";")
+        quality = 1.0
+        for param in params:
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    return qualities.get("gzip", qualities.get("*", 0.0)) > 0
+
+
+def poll_headers(request: Request, md5: str) -> dict:
+    """
+    Note the frame served to the requesting device, and tell it when to poll
+    next: X-Next-Poll-After, in seconds, based on the time since the latest
+    upload and the next rotation step. Call after the route looked up the
+    current frame, so the latest-image index is fresh.
+    """
+    device_id = request.headers.get(DEVICE_HEADER)
+    if device_id:
+        device_registry.seen(device_id, md5=md5)
+    _, next_change_in = rotation_slot(len(latest_images))
+    hint = next_poll_after(
+        time.time() - latest_image_mtime / 1e9,
+        POLL_MIN_INTERVAL,
+        POLL_MAX_INTERVAL,
+        POLL_ACTIVITY_RATIO,
+        POLL_JITTER,
+        next_change_in,
+    )
+    return {"X-Next-Poll-After": str(hint)}
 
-        # Convert to 1-bit black & white
-        img = img.convert("1", dither=Image.FLOYDSTEINBERG)
 
-        # Draw username in the lower-right corner
-        draw_username(img, username)
+def frame_response(
+    request: Request, content: bytes | str, media_type: str, etag: str, headers: dict | None = None
+) -> Response:
+    """
+    Serve a rendered artifact with a strong ETag and Cache-Control, answering
+    a matching If-None-Match with an empty 304 so unchanged polls cost no body.
+    The device header picks the profile (see profile_for) and the poll hint,
+    so caches must keep a copy per device (Vary).
+    """
+    headers = {**(headers or {})}
+    headers["Vary"] = ", ".join(filter(None, (headers.get("Vary"), DEVICE_HEADER)))
+    headers["ETag"] = etag
+    headers["Cache-Control"] = f"public, max-age={FRAME_CACHE_MAX_AGE}"
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=content, media_type=media_type, headers=headers)
 
-        # Return as JPEG
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format="JPEG")
-        img_byte_arr.seek(0)
 
-        return Response(content=img_byte_arr.read(), media_type="image/jpeg")
+#
+# 4. The /get_last_img route
+#
+async def get_last_img(request: Request) -> Response:
+    """Serve the latest uploaded image as a 256x122 black & white JPEG, watermarked."""
+    profile = profile_for(request)
+    if profile is None:
+        return unknown_profile_response()
+    try:
+        frame = await get_latest_frame(profile)
+        if frame is None:
+            return JSONResponse({"error": "No images found."}, status_code=404)
+
+        headers = poll_headers(request, frame.md5)
+        return frame_response(request, frame.jpeg, "image/jpeg", f'"{frame.md5}-jpg"', headers)
+    except Overloaded:
+        return overloaded_response()
     except Exception as e:
         logger.error(f"Error serving the latest image: {e}")
         return JSONResponse({"error": "Internal server error."}, status_code=500)
 
 
 #
-# 4. The /get_last_xbm route
+# 5. The /get_last_xbm route
 #
 async def get_last_xbm(request: Request) -> Response:
     """
@@ -299,286 +734,770 @@ async def get_last_xbm(request: Request) -> Response:
       2) Converting to pure black & white (no grayscale)
       3) Watermarking with the username
       4) Generating a valid XBM string
+
+    Send the ETag of the last response as If-None-Match to get an empty 304
+    while the frame is unchanged, instead of polling /get_last_md5 first.
     """
+    profile = profile_for(request)
+    if profile is None:
+        return unknown_profile_response()
     try:
-        # Sort by modification time (newest first)
-        image_files = sorted(
-            (
-                os.path.join(IMAGE_DIR, f)
-                for f in os.listdir(IMAGE_DIR)
-                if f.endswith(".jpg")
-            ),
-            key=os.path.getmtime,
-            reverse=True,
-        )
-        if not image_files:
+        frame = await get_latest_frame(profile)
+        if frame is None:
             return JSONResponse({"error": "No images found."}, status_code=404)
 
-        latest_image_path = image_files[0]
-        username = parse_username_from_filename(latest_image_path)
-
-        # Open with Pillow
-        img = Image.open(latest_image_path)
+        headers = poll_headers(request, frame.md5)
+        return frame_response(request, frame.xbm, "text/plain", f'"{frame.md5}-xbm"', headers)
+    except Overloaded:
+        return overloaded_response()
+    except Exception as e:
+        logger.error(f"Error creating XBM: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
 
-        # Resize to 256x122 (unproportional)
-        img = img.resize((256, 122), Image.Resampling.NEAREST)
 
-        # Convert to pure 1-bit black & white
-        img = img.convert("1", dither=Image.FLOYDSTEINBERG)
+#
+# 6. The /get_last_frame route
+#
+async def get_last_frame(request: Request) -> Response:
+    """
+    Return the latest frame as raw packed bits for newer firmware:
+    a 20-byte header (uint16 width, uint16 height, 16-byte frame hash)
+    followed by width * height bits in the same order as the XBM array.
+    Gzip-compressed when the client accepts it.
+    """
+    profile = profile_for(request)
+    if profile is None:
+        return unknown_profile_response()
+    try:
+        frame = await get_latest_frame(profile)
+        if frame is None:
+            return JSONResponse({"error": "No images found."}, status_code=404)
 
-        # Watermark
-        draw_username(img, username)
+        headers = {"Vary": "Accept-Encoding", **poll_headers(request, frame.md5)}
+        if accepts_gzip(request):
+            headers["Content-Encoding"] = "gzip"
+            content, etag = frame.binary_gzip, f'"{frame.md5}-bin-gz"'
+        else:
+            content, etag = frame.binary, f'"{frame.md5}-bin"'
+        return frame_response(request, content, "application/octet-stream", etag, headers)
+    except Overloaded:
+        return overloaded_response()
+    except Exception as e:
+        logger.error(f"Error serving the binary frame: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
 
-        # Build XBM string
-        xbm_str = generate_xbm_string(img)
 
-        # Return as text
-        return PlainTextResponse(xbm_str, media_type="text/plain")
+#
+# 7. The /get_frame_diff route
+#
+async def get_frame_diff(request: Request) -> Response:
+    """
+    `?md5=<hash of the frame the device shows>`: return only what changed
+    since that frame (render.frame_diff, X-Frame-Format: diff), so the device
+    downloads less and partial-refresh firmware can redraw only the changed
+    rows. Falls back to the full /get_last_frame body (X-Frame-Format: full)
+    when the device's frame is unknown or the diff would not be much smaller.
+    If the device already shows the current frame the diff has no runs; send
+    the last ETag as If-None-Match to get an empty 304 instead.
+
+    Diffs only pay off for profiles with `"dither": "ordered"` (or "none"):
+    error diffusion spreads any change in the upload over the rest of the
+    frame, so floyd-steinberg and atkinson frames nearly always get the full
+    frame (see benchmark.bench_frame_diff).
+    """
+    profile = profile_for(request)
+    if profile is None:
+        return unknown_profile_response()
+    base_md5 = request.query_params.get("md5", "")
+    try:
+        frame = await get_latest_frame(profile)
+        if frame is None:
+            return JSONResponse({"error": "No images found."}, status_code=404)
+        hints = poll_headers(request, frame.md5)
+
+        # Anything but a frame hash gets the full frame, and no cache entry
+        diff = diff_cache.get((profile.name, base_md5, frame.md5)) if FRAME_HASH.fullmatch(base_md5) else b""
+        if diff is None:
+            base = await executor.run_io(find_recent_frame, base_md5, profile)
+            diff = frame_diff(base, frame) if base is not None else None
+            if diff is None or len(diff) > len(frame.binary) * FRAME_DIFF_MAX_RATIO:
+                diff = b""
+            diff_cache.put((profile.name, base_md5, frame.md5), diff)
+
+        if not diff:
+            headers = {"X-Frame-Format": "full", **hints}
+            content, etag = frame.binary, f'"{frame.md5}-bin"'
+        else:
+            headers = {"X-Frame-Format": "diff", **hints}
+            content, etag = diff, f'"{base_md5}-{frame.md5}-diff"'
+        return frame_response(request, content, "application/octet-stream", etag, headers)
+    except Overloaded:
+        return overloaded_response()
     except Exception as e:
-        logger.error(f"Error creating XBM: {e}")
+        logger.error(f"Error serving the frame diff: {e}")
         return JSONResponse({"error": "Internal server error."}, status_code=500)
 
 
-def generate_xbm_string(img: Image.Image) -> str:
+#
+# 8. Long-poll and SSE routes: wait for the next meme instead of polling
+#
+async def notify_new_frame() -> None:
     """
-    Generate a minimal XBM string from a 1-bit Pillow image.
-    We'll assume the image is exactly 256x122 in '1' mode.
+    Look up the current frame hash once per profile, then wake every request
+    of this worker that is waiting for a new frame; they read the hash from
+    current_md5s instead of each looking it up.
     """
-    width, height = img.size
-    pixels = img.load()
+    global new_frame_event
+    for profile in DEVICE_PROFILES.values():
+        try:
+            current_md5s[profile.name] = await current_frame_md5(profile)
+        except Exception as e:
+            logger.error(f"Error reading the current frame ({profile.name}): {e}")
+    event, new_frame_event = new_frame_event, asyncio.Event()
+    event.set()
 
-    # Build a list of hex values, 1 bit per pixel => 8 pixels per byte
-    xbm_data = []
-    byte_val = 0
-    bit_index = 0
 
-    # PIL '1' mode => 0 = Black, 255 = White
-    # We'll define 'black' => bit=1, 'white' => bit=0 to match typical XBM usage
-    for y in range(height):
-        for x in range(width):
-            pixel_value = pixels[x, y]  # 0 or 255
-            bit = 1 if pixel_value == 0 else 0
-            byte_val |= bit << bit_index
-            bit_index += 1
-            if bit_index == 8:
-                xbm_data.append(f"0x{byte_val:02x}")
-                byte_val = 0
-                bit_index = 0
+async def watch_latest_image() -> None:
+    """
+    Uploads are handled by whichever process runs the bot. One cheap stat()
+    loop per worker notices them, and rotation steps, and wakes this worker's
+    waiters, so idle connections themselves never poll. Whenever the latest
+    images change they are cataloged and pre-rendered (see prepare_images).
+    """
+    known_images = []
+    known_image = await executor.run_io(current_image)
+    while True:
+        try:
+            images = list(await executor.run_io(get_latest_images))
+            image = await executor.run_io(current_image)
+        except Exception as e:
+            logger.error(f"Error watching {IMAGE_DIR}: {e}")
+            await asyncio.sleep(FRAME_WATCH_INTERVAL)
+            continue
+        if image != known_image:
+            known_image = image
+            await notify_new_frame()
+        if images != known_images:
+            known_images = images
+            await prepare_images(images)
+        await asyncio.sleep(FRAME_WATCH_INTERVAL)
+
+
+async def prepare_images(images: list) -> None:
+    """Catalog new files, and render the frames of `images` before any device asks."""
+    try:
+        added = await executor.run_io(sync_catalog)
+        if added:
+            logger.info(f"Cataloged {added} new images")
+        await asyncio.gather(
+            *(get_rendered_frame(image_path, profile) for image_path in images for profile in DEVICE_PROFILES.values())
+        )
+        pruned = await executor.run_io(frame_store.prune)
+        if pruned:
+            logger.info(f"Pruned {pruned} frames from the frame store")
+    except Exception as e:
+        logger.error(f"Failed to prepare the latest images: {e}")
+
+
+async def wait_for_frame(request: Request) -> Response:
+    """
+    Long-poll: `?md5=<hash of the frame the device shows>&timeout=<seconds>`.
+    Returns the current frame hash as soon as it differs from `md5`, or the
+    unchanged hash when the timeout expires.
+    """
+    profile = profile_for(request)
+    if profile is None:
+        return unknown_profile_response()
+    known_md5 = request.query_params.get("md5", "")
+    try:
+        timeout = float(request.query_params.get("timeout", LONG_POLL_TIMEOUT))
+    except ValueError:
+        return JSONResponse({"error": "Invalid timeout."}, status_code=400)
+    timeout = max(0.0, min(timeout, LONG_POLL_MAX_TIMEOUT))
+
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        # Take the event before checking, so a frame arriving in between isn't missed
+        event = new_frame_event
+        md5 = await current_frame_md5(profile)
+        while (md5 is None or md5 == known_md5) and loop.time() < deadline:
+            try:
+                await asyncio.wait_for(event.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                break
+            event = new_frame_event
+            md5 = current_md5s.get(profile.name) or md5
 
-    # Flush any partial byte
-    if bit_index > 0:
-        xbm_data.append(f"0x{byte_val:02x}")
+        if md5 is None:
+            return JSONResponse({"error": "No images found."}, status_code=404)
+        return Response(md5, headers={"Cache-Control": "no-store", **poll_headers(request, md5)})
+    except Overloaded:
+        return overloaded_response()
+    except Exception as e:
+        logger.error(f"Error waiting for a new frame: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
 
-    # Build final text output
-    xbm_str = f"#define wifi_width {width}\n"
-    xbm_str += f"#define wifi_height {height}\n"
-    xbm_str += "static const unsigned char wifi_bits[] = {\n  "
-    xbm_str += ", ".join(xbm_data)
-    xbm_str += "\n};\n"
 
-    return xbm_str
+async def frame_events(request: Request) -> Response:
+    """Server-sent events stream: one `frame` event with the hash of every new frame."""
+    profile = profile_for(request)
+    if profile is None:
+        return unknown_profile_response()
+
+    async def stream():
+        last_md5 = None
+        event = new_frame_event
+        try:
+            md5 = await current_frame_md5(profile)
+        except Exception as e:
+            logger.error(f"Error reading the current frame for SSE: {e}")
+            md5 = None
+        while True:
+            if md5 is not None and md5 != last_md5:
+                last_md5 = md5
+                yield f"event: frame\ndata: {md5}\n\n"
+            try:
+                await asyncio.wait_for(event.wait(), SSE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            event = new_frame_event
+            md5 = current_md5s.get(profile.name)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-store", "X-Accel-Buffering": "no"},
+    )
 
 
 async def get_last_md5(request: Request) -> JSONResponse:
     """
-    Return the MD5 hash of the latest uploaded image file, using a simple cache
-    to avoid recalculating if the file is unchanged.
+    Return the hash of the frame currently served to the devices. It changes
+    whenever the served frame does, including after a change to the rendering
+    pipeline. The lookup runs in a thread so file I/O never blocks the loop.
     """
-    global last_md5_file, last_md5
+    profile = profile_for(request)
+    if profile is None:
+        return unknown_profile_response()
     try:
-        image_files = sorted(
-            (
-                os.path.join(IMAGE_DIR, f)
-                for f in os.listdir(IMAGE_DIR)
-                if f.endswith(".jpg")
-            ),
-            key=os.path.getmtime,
-            reverse=True,
-        )
-
-        if not image_files:
+        md5 = await current_frame_md5(profile)
+        if md5 is None:
             return JSONResponse({"error": "No images found."}, status_code=404)
-
-        latest_image_path = image_files[0]
-        if latest_image_path == last_md5_file:
-            # Return the cached MD5
-            return Response(last_md5)
-        else:
-            # Compute new MD5, update cache
-            with open(latest_image_path, "rb") as file:
-                new_md5 = hashlib.md5(file.read()).hexdigest()
-            last_md5_file = latest_image_path
-            last_md5 = new_md5
-            return Response(new_md5)
+        return Response(md5, headers=poll_headers(request, md5))
+    except Overloaded:
+        return overloaded_response()
     except Exception as e:
         logger.error(f"Error calculating MD5 hash: {e}")
         return JSONResponse({"error": "Internal server error."}, status_code=500)
 
 
-async def get_wifi_book(request: Request) -> JSONResponse:
-    """Serve the networks.json file as a JSON response."""
+#
+# 9. Metrics: request latencies, render stages, caches, event-loop lag
+#
+async def watch_event_loop_lag() -> None:
+    """Sleep for LOOP_LAG_INTERVAL and record how late the wake-up came."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.observe(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+
+
+async def get_metrics(request: Request) -> PlainTextResponse:
+    """Serve this worker's metrics in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def json_body(content) -> bytes:
+    """`content` encoded exactly as a JSONResponse would."""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def load_wifi_book() -> dict:
+    """
+    Blocking: the Wi-Fi book, from memory while its version is unchanged. The
+    version check is one indexed query; the networks are only read, and the
+    full list serialized and gzipped, after the bot added or changed one.
+    """
+    global wifi_book
+    version = storage.get_networks_version()
+    if wifi_book is None or wifi_book["version"] != version:
+        networks = storage.get_networks()
+        body = json_body([{"ssid": n["ssid"], "password": n["password"]} for n in networks])
+        wifi_book = {"version": version, "networks": networks, "body": body, "gzip": gzip.compress(body, mtime=0)}
+    return wifi_book
+
+
+async def get_wifi_book(request: Request) -> Response:
+    """
+    Serve the shared Wi-Fi networks as a JSON list of {"ssid", "password"}.
+    With `?since=<version>`, only the networks added or changed after that
+    version: {"version", "full": false, "networks": [...]}, to merge by SSID
+    ("full": true if `since` is unknown, e.g. newer than the book; replace the
+    list then). The book version is sent as X-Wifi-Book-Version and in the
+    ETag, so an unchanged book costs an empty 304. Gzip-compressed if the
+    client accepts it.
+    """
+    since = request.query_params.get("since")
+    try:
+        since = int(since) if since is not None else None
+    except ValueError:
+        return JSONResponse({"error": "Invalid version."}, status_code=400)
     try:
-        if os.path.exists(NETWORKS_FILE):
-            with open(NETWORKS_FILE, "r") as file:
-                wifi_book = json.load(file)
-            return JSONResponse(wifi_book)
+        book = await executor.run_io(load_wifi_book)
+        version = book["version"]
+        use_gzip = accepts_gzip(request)
+        encoding = "-gz" if use_gzip else ""
+        headers = {"Vary": "Accept-Encoding", "X-Wifi-Book-Version": str(version)}
+        if use_gzip:
+            headers["Content-Encoding"] = "gzip"
+
+        if since is None:
+            if not book["networks"]:
+                return JSONResponse({"error": "Wi-Fi book not found."}, status_code=404)
+            headers["ETag"] = f'"wifi-{version}{encoding}"'
+            content = book["gzip"] if use_gzip else book["body"]
         else:
-            return JSONResponse({"error": "Wi-Fi book not found."}, status_code=404)
+            headers["ETag"] = f'"wifi-{since}-{version}{encoding}"'
+            full = since > version
+            changes = [
+                {"ssid": n["ssid"], "password": n["password"]}
+                for n in book["networks"]
+                if full or n["version"] > since
+            ]
+            content = json_body({"version": version, "full": full, "networks": changes})
+            if use_gzip:
+                content = gzip.compress(content, mtime=0)
+
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+        return Response(content, media_type="application/json", headers=headers)
+    except Overloaded:
+        return overloaded_response()
     except Exception as e:
         logger.error(f"Error serving Wi-Fi book: {e}")
         return JSONResponse({"error": "Internal server error."}, status_code=500)
 
 
-async def share_wifi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Initiate the process of sharing WiFi."""
-    if update.callback_query:
-        # If triggered from a button, acknowledge and edit the message
-        await update.callback_query.answer()
-        await update.callback_query.message.delete()
-        await update.callback_query.message.reply_text("Введите имя сети WiFi:")
-    elif update.message:
-        # If triggered from a command or keyboard button
-        await update.message.reply_text("Введите имя сети WiFi:")
-    return WIFI_NAME
+#
+# 10. Device registry: which boards poll, with which firmware and frame
+#
+async def save_devices() -> None:
+    """Write the devices changed since the last call to the database, in one batch."""
+    changes = device_registry.take_changes()
+    if changes:
+        try:
+            await executor.run_io(storage.save_devices, changes, MAX_DEVICES)
+        except Exception as e:
+            logger.error(f"Failed to save {len(changes)} devices: {e}")
+
+
+async def flush_devices() -> None:
+    while True:
+        await asyncio.sleep(DEVICE_FLUSH_INTERVAL)
+        await save_devices()
+
+
+async def get_devices(request: Request) -> JSONResponse:
+    """
+    Every device that sent X-Device-Id, most recently seen first: firmware
+    version, hash of the frame last served, profile, first and last seen.
+    Other workers' changes show up within DEVICE_FLUSH_INTERVAL.
+    """
+    try:
+        await save_devices()
+        devices = await executor.run_io(storage.get_devices)
+        return JSONResponse(
+            [
+                {
+                    **device,
+                    "last_seen": datetime.fromtimestamp(device["last_seen"]).isoformat(timespec="seconds"),
+                    "profile": DEVICE_PROFILE_MAP.get(device["device_id"], "default"),
+                }
+                for device in devices
+            ]
+        )
+    except Overloaded:
+        return overloaded_response()
+    except Exception as e:
+        logger.error(f"Error listing devices: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
+
+
+#
+# 11. Meme archive: the catalog, thumbnails and the rotation
+#
+def sync_catalog() -> int:
+    """Catalog the images in IMAGE_DIR that have no row yet. Returns how many were added."""
+    known = storage.get_image_filenames()
+    with os.scandir(IMAGE_DIR) as entries:
+        new_images = [
+            parse_image_filename(entry.name)
+            for entry in entries
+            if entry.name.endswith(".jpg") and entry.name not in known and entry.is_file()
+        ]
+    return storage.add_existing_images(new_images) if new_images else 0
+
+
+def archive_item(image: dict) -> dict:
+    """The public fields of a catalog row. `image` is null once retention deleted the original."""
+    originals = {
+        "file": f"/data/{image['filename']}",
+        "pack": f"/archive/{image['id']}/image",
+        "deleted": None,
+    }
+    return {
+        "id": image["id"],
+        "username": image["username"],
+        "caption": image["caption"],
+        "uploaded_at": image["uploaded_at"],
+        "image": originals[image["stored"]],
+        "thumbnail": f"/archive/{image['id']}/thumbnail",
+    }
 
 
-async def handle_wifi_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handle WiFi name input."""
-    context.user_data["wifi_name"] = update.message.text
-    await update.message.reply_text("Теперь введите пароль для WiFi:")
-    return WIFI_PASSWORD
+def thumbnail_path_for(image_path: str) -> str:
+    stem = os.path.splitext(os.path.basename(image_path))[0]
+    return os.path.join(RENDER_DIR, stem, f"thumb-{THUMBNAIL_SIZE}.jpg")
 
 
-async def handle_wifi_password(
-    update: Update, context: ContextTypes.DEFAULT_TYPE
-) -> int:
-    """Handle WiFi password input."""
-    wifi_name = context.user_data.get("wifi_name")
-    wifi_password = update.message.text
+def load_thumbnail(image_path: str) -> tuple:
+    """
+    Blocking lookup of a stored thumbnail. Returns (source key, JPEG bytes or
+    None if it was never made or the upload changed since). Once retention
+    removed the upload, the thumbnail made before is returned as it is; raises
+    FileNotFoundError if there is none.
+    """
+    thumbnail_path = thumbnail_path_for(image_path)
+    try:
+        key = source_key(image_path)
+    except FileNotFoundError:
+        with open(thumbnail_path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            return (thumbnail_path, stat.st_mtime_ns, stat.st_size), file.read()
+    try:
+        if os.stat(thumbnail_path).st_mtime_ns >= key[1]:
+            with open(thumbnail_path, "rb") as file:
+                return key, file.read()
+    except FileNotFoundError:
+        pass
+    return key, None
+
+
+async def ensure_thumbnail(image_path: str) -> tuple:
+    """Like load_thumbnail, but makes the thumbnail (in the render processes) if needed."""
+    key, jpeg = await executor.run_io(load_thumbnail, image_path)
+    if jpeg is None:
+        await executor.run_render(
+            ("thumbnail", key), render_thumbnail, image_path, thumbnail_path_for(image_path), THUMBNAIL_SIZE
+        )
+        key, jpeg = await executor.run_io(load_thumbnail, image_path)
+    return key, jpeg
 
-    if not wifi_name:
-        await update.message.reply_text("Произошла ошибка. Пожалуйста, начните снова.")
-        return ConversationHandler.END
 
+async def get_archive(request: Request) -> JSONResponse:
+    """
+    One page of uploads, newest first: `?page=<1..>&per_page=<n>&user=<username>`.
+    Returns {"total", "page", "per_page", "items": [...]}.
+    """
     try:
-        if os.path.exists(NETWORKS_FILE):
-            with open(NETWORKS_FILE, "r") as file:
-                networks = json.load(file)
-        else:
-            networks = []
+        page = max(1, int(request.query_params.get("page", 1)))
+        per_page = min(ARCHIVE_MAX_PAGE_SIZE, max(1, int(request.query_params.get("per_page", ARCHIVE_PAGE_SIZE))))
+    except ValueError:
+        return JSONResponse({"error": "Invalid page."}, status_code=400)
+    try:
+        total, images = await executor.run_io(
+            storage.list_images, (page - 1) * per_page, per_page, request.query_params.get("user")
+        )
+        return JSONResponse(
+            {
+                "total": total,
+                "page": page,
+                "per_page": per_page,
+                "items": [archive_item(image) for image in images],
+            }
+        )
+    except Overloaded:
+        return overloaded_response()
+    except Exception as e:
+        logger.error(f"Error listing the archive: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
+
+
+async def get_archive_item(request: Request) -> JSONResponse:
+    try:
+        image = await executor.run_io(storage.get_image, request.path_params["image_id"])
+        if image is None:
+            return JSONResponse({"error": "Image not found."}, status_code=404)
+        return JSONResponse(archive_item(image))
+    except Overloaded:
+        return overloaded_response()
+    except Exception as e:
+        logger.error(f"Error serving an archive item: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
+
 
-        # Add new network
-        networks.append({"ssid": wifi_name, "password": wifi_password})
+async def get_thumbnail(request: Request) -> Response:
+    """A JPEG thumbnail of an upload, made on first request and stored under RENDER_DIR."""
+    try:
+        image = await executor.run_io(storage.get_image, request.path_params["image_id"])
+        if image is None:
+            return JSONResponse({"error": "Image not found."}, status_code=404)
+        image_path = os.path.join(IMAGE_DIR, image["filename"])
+        try:
+            key, jpeg = await ensure_thumbnail(image_path)
+        except FileNotFoundError:
+            return JSONResponse({"error": "Image file not found."}, status_code=404)
+        return frame_response(request, jpeg, "image/jpeg", f'"{key[1]:x}-{key[2]:x}-thumb"')
+    except Overloaded:
+        return overloaded_response()
+    except Exception as e:
+        logger.error(f"Error serving a thumbnail: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
 
-        # Write back to file
-        with open(NETWORKS_FILE, "w") as file:
-            json.dump(networks, file, indent=4)
 
-        await update.message.reply_text(
-            f"WiFi '{wifi_name}' успешно добавлен.\n\n{WIFI_CONNECT_TEXT}"
+async def get_packed_image(request: Request) -> Response:
+    """The original of an upload that retention moved into the pack file."""
+    try:
+        image = await executor.run_io(storage.get_image, request.path_params["image_id"])
+        if image is None or image["stored"] != "pack":
+            return JSONResponse({"error": "Packed image not found."}, status_code=404)
+        jpeg = await executor.run_io(read_from_pack, PACK_FILE, image["pack_offset"], image["pack_length"])
+        etag = f'"{image["pack_offset"]:x}-{image["pack_length"]:x}-pack"'
+        return frame_response(request, jpeg, "image/jpeg", etag)
+    except Overloaded:
+        return overloaded_response()
+    except Exception as e:
+        logger.error(f"Error serving a packed image: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
+
+
+async def get_rotation(request: Request) -> JSONResponse:
+    """
+    The memes devices currently cycle through (newest first), which one is
+    shown, and seconds until the next one (null without rotation).
+    """
+    try:
+        images = await executor.run_io(get_latest_images)
+        position, next_change_in = await executor.run_io(rotation_position)
+        return JSONResponse(
+            {
+                "size": ROTATION_SIZE,
+                "interval": ROTATION_INTERVAL,
+                "position": position,
+                "next_change_in": next_change_in,
+                "images": [f"/data/{os.path.basename(image_path)}" for image_path in images],
+            }
         )
+    except Overloaded:
+        return overloaded_response()
     except Exception as e:
-        logger.error(f"Failed to save WiFi network: {e}")
-        await update.message.reply_text("Произошла ошибка при сохранении WiFi. Попробуйте ещё раз.")
+        logger.error(f"Error serving the rotation: {e}")
+        return JSONResponse({"error": "Internal server error."}, status_code=500)
 
-    # Show the main menu again after completion
-    await show_main_menu(update, context)
-    return ConversationHandler.END
 
+#
+# 12. Retention: pack or delete old originals, keep what devices and the archive serve
+#
+def list_originals() -> list:
+    """The .jpg files in IMAGE_DIR as (mtime, size, filename), newest first."""
+    images = []
+    with os.scandir(IMAGE_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith(".jpg") and entry.is_file():
+                stat = entry.stat()
+                images.append((stat.st_mtime, stat.st_size, entry.name))
+    return sorted(images, reverse=True)
+
+
+def retire_original(filename: str) -> None:
+    """
+    Blocking: move an original into the pack (or just drop it, per
+    RETENTION_MODE), record that in the catalog, then delete the file. A crash
+    in between leaves the file in place, to be retired again on the next pass.
+    The identity of the original is kept next to its frames (see source_key).
+    """
+    image_path = os.path.join(IMAGE_DIR, filename)
+    _, mtime_ns, size = source_key(image_path)
+    retired_source_path = retired_source_path_for(image_path)
+    os.makedirs(os.path.dirname(retired_source_path), exist_ok=True)
+    with open(retired_source_path, "w") as file:
+        json.dump({"mtime_ns": mtime_ns, "size": size}, file)
+    if RETENTION_MODE == "pack":
+        with open(image_path, "rb") as file:
+            data = file.read()
+        offset = append_to_pack(PACK_FILE, filename, data)
+        storage.retire_image(filename, "pack", offset, len(data))
+    else:
+        storage.retire_image(filename, "deleted")
+    os.remove(image_path)
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Show the main menu with available actions using ReplyKeyboardMarkup."""
-    keyboard = [
-        [KeyboardButton("Загрузить мем"), KeyboardButton("Добавить Wi-Fi")],
-        [KeyboardButton("Об Анатолии Васильевиче")],
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
 
+def recover_pack_catalog() -> int:
+    """
+    Blocking: catalog the originals in the pack that the catalog does not
+    list as packed (e.g. the database was lost or restored from an older
+    backup), from the pack's own record headers; the last record of a name
+    wins. Originals still in IMAGE_DIR are left alone: their retirement was
+    cut short and is redone by the next pass. Returns how many were recovered.
+    """
+    if not os.path.exists(PACK_FILE):
+        return 0
+    packed = storage.get_packed_filenames()
+    records = {}
+    for filename, offset, length in read_pack_index(PACK_FILE):
+        if filename not in packed and not os.path.exists(os.path.join(IMAGE_DIR, filename)):
+            records[filename] = offset, length
+    images = [
+        {**parse_image_filename(filename), "pack_offset": offset, "pack_length": length}
+        for filename, (offset, length) in records.items()
+    ]
+    return storage.restore_packed_images(images) if images else 0
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Send a message when the command /help is issued."""
-    await update.message.reply_text(ABOUT_TEXT)
 
+async def render_before_retiring(image_path: str, profile: DeviceProfile) -> None:
+    """
+    Render the stored artifacts of an upload for `profile` unless they exist,
+    like get_rendered_frame but without adding the frame to the frame store,
+    so retiring many old uploads doesn't push out the frames devices poll.
+    """
+    key, md5 = await executor.run_io(find_frame_md5, image_path, profile)
+    if md5 is None:
+        label = await executor.run_io(image_label, image_path)
+        await executor.run_render(
+            ("retire", key, profile.name),
+            render_and_save,
+            image_path,
+            label,
+            frame_dir_for(image_path, profile),
+            source_stamp(key, profile),
+            profile,
+        )
 
-async def handle_main_menu_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle user selections from the main menu."""
-    user_selection = update.message.text.lower()
 
-    if user_selection == "загрузить мем":
-        await update.message.reply_text("Просто загрузи картинку как ты обычно делаешь в Телеграме.")
-    elif user_selection == "добавить wi-fi":
-        await share_wifi(update, context)
-    elif user_selection == "об анатолии васильевиче":
-        await help_command(update, context)
-    # else:
-    #     await update.message.reply_text("Не понял, попробуй еще раз.")
+async def enforce_retention() -> int:
+    """
+    One retention pass over IMAGE_DIR, in at most one worker at a time (the
+    others skip it). The images in rotation are always kept. Before an
+    original goes, its frames for every profile and its thumbnail are made, so
+    they outlive it. Returns how many originals were retired.
+    """
+    lock = await executor.run_io(try_file_lock, RETENTION_LOCK_FILE)
+    if lock is None:
+        return 0
+    try:
+        await executor.run_io(sync_catalog)
+        expired = select_expired(
+            await executor.run_io(list_originals),
+            max_age=RETENTION_MAX_AGE_DAYS * 86400,
+            max_count=RETENTION_MAX_COUNT,
+            max_bytes=RETENTION_MAX_BYTES,
+            keep=max(1, ROTATION_SIZE),
+            now=time.time(),
+        )
+        # Oldest first, so an interrupted pass still retired the oldest ones
+        for _, _, filename in reversed(expired):
+            image_path = os.path.join(IMAGE_DIR, filename)
+            for profile in DEVICE_PROFILES.values():
+                await render_before_retiring(image_path, profile)
+            await ensure_thumbnail(image_path)
+            await executor.run_io(retire_original, filename)
+            retired_images.inc(RETENTION_MODE)
+        if expired:
+            logger.info(f"Retention: {RETENTION_MODE} {len(expired)} originals")
+        return len(expired)
+    finally:
+        lock.close()
+
+
+async def retention_loop() -> None:
+    """Run a retention pass every RETENTION_INTERVAL seconds, the first one at startup."""
+    while True:
+        try:
+            await enforce_retention()
+        except Exception as e:
+            logger.error(f"Retention pass failed: {e}")
+        await asyncio.sleep(RETENTION_INTERVAL)
 
 
 routes = [
-    Route("/telegram", endpoint=telegram_webhook, methods=["POST"]),
     Route("/get_last_img", endpoint=get_last_img, methods=["GET"]),
     Route("/get_last_xbm", endpoint=get_last_xbm, methods=["GET"]),
+    Route("/get_last_frame", endpoint=get_last_frame, methods=["GET"]),
     Route("/get_last_md5", endpoint=get_last_md5, methods=["GET"]),
+    Route("/get_frame_diff", endpoint=get_frame_diff, methods=["GET"]),
+    Route("/wait_for_frame", endpoint=wait_for_frame, methods=["GET"]),
+    Route("/frame_events", endpoint=frame_events, methods=["GET"]),
     Route("/get_wifi_book", endpoint=get_wifi_book, methods=["GET"]),
+    Route("/metrics", endpoint=get_metrics, methods=["GET"]),
+    Route("/devices", endpoint=get_devices, methods=["GET"]),
+    Route("/archive", endpoint=get_archive, methods=["GET"]),
+    Route("/archive/rotation", endpoint=get_rotation, methods=["GET"]),
+    Route("/archive/{image_id:int}", endpoint=get_archive_item, methods=["GET"]),
+    Route("/archive/{image_id:int}/thumbnail", endpoint=get_thumbnail, methods=["GET"]),
+    Route("/archive/{image_id:int}/image", endpoint=get_packed_image, methods=["GET"]),
 ]
-
-app = Starlette(routes=routes)
+if BOT_MODE == "webhook":
+    routes.append(Route("/telegram", endpoint=telegram_webhook, methods=["POST"]))
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        Middleware(
+            MetricsMiddleware,
+            requests=http_requests,
+            latency=http_latency,
+            routes=routes,
+        ),
+        Middleware(
+            DeviceMiddleware,
+            registry=device_registry,
+            device_header=DEVICE_HEADER,
+            firmware_header=FIRMWARE_HEADER,
+        ),
+    ],
+)
 
 
 async def on_startup() -> None:
-    """Configure handlers and set webhook on startup."""
-    wifi_conversation_handler = ConversationHandler(
-        entry_points=[
-            CommandHandler("share_wifi", share_wifi),
-            CallbackQueryHandler(share_wifi, pattern="share_wifi"),
-            MessageHandler(filters.Regex("^Добавить Wi-Fi$"), share_wifi),
-        ],
-        states={
-            WIFI_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_wifi_name)],
-            WIFI_PASSWORD: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_wifi_password)
-            ],
-        },
-        fallbacks=[CommandHandler("cancel", cancel_conversation)],
-        allow_reentry=True,
-    )
-    application.add_handler(wifi_conversation_handler)
+    """
+    Start the pools and background tasks. The device routes need nothing
+    else; the bot is started in the background, in one worker only.
+    """
+    global frame_watch_task, loop_lag_task, retention_task, device_flush_task, bot_claim_task
 
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
-    application.add_handler(
-        CallbackQueryHandler(button_handler, pattern="^(?!share_wifi).*")
-    )
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_main_menu_selection)
-    )
+    executor.start()
 
-    await application.initialize()
-    await application.start()
+    # Seed the latest-image index before the first device poll
+    await executor.run_io(get_latest_images)
+    frame_watch_task = asyncio.create_task(watch_latest_image())
+    loop_lag_task = asyncio.create_task(watch_event_loop_lag())
+    device_registry.load(await executor.run_io(storage.get_devices))
+    device_flush_task = asyncio.create_task(flush_devices())
+    try:
+        recovered = await executor.run_io(recover_pack_catalog)
+        if recovered:
+            logger.info(f"Recovered {recovered} packed originals missing from the catalog")
+    except Exception as e:
+        logger.error(f"Failed to read {PACK_FILE}: {e}")
+    if RETENTION_MAX_AGE_DAYS or RETENTION_MAX_COUNT or RETENTION_MAX_BYTES:
+        retention_task = asyncio.create_task(retention_loop())
 
-    # Set webhook
-    webhook_url = f"{DOMAIN_NAME}/telegram"
-    await application.bot.set_webhook(webhook_url)
-    logger.info(f"Webhook set to {webhook_url}")
+    if BOT_MODE == "webhook":
+        bot_claim_task = asyncio.create_task(claim_bot())
 
 
 async def on_shutdown() -> None:
-    """Shutdown the PTB Application and remove webhook."""
-    await application.bot.delete_webhook()
-    await application.stop()
-    logger.info("Webhook removed")
-
-
-async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Handle cancellation of the conversation."""
-    if update.callback_query:
-        await update.callback_query.answer()
-        await update.callback_query.message.reply_text("Разговор отменён.")
-    else:
-        await update.message.reply_text("Разговор отменён.")
-    return ConversationHandler.END
+    """Stop the bot (if this worker runs it), the background tasks and the pools."""
+    for task in (frame_watch_task, loop_lag_task, retention_task, device_flush_task, bot_claim_task):
+        if task is not None:
+            task.cancel()
+    await save_devices()
+    if bot is not None:
+        await bot.stop_webhook()
+    executor.shutdown()
 
 
 app.add_event_handler("startup", on_startup)
@@ -590,4 +1509,5 @@ app.mount("/data", StaticFiles(directory=IMAGE_DIR), name="data")
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=7462)
+    # By import string, so bot.py imports this same module instead of a second copy
+    uvicorn.run("anatoliy:app", host="0.0.0.0", port=7462)
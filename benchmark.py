@@ -0,0 +1,496 @@
+"""
+Micro-benchmarks for the rendering hot paths, and a load test of the device
+polling routes. Everything runs offline, in-process.
+
+Run with:  python benchmark.py [--devices 50] [--rounds 20] [--output results.json]
+Compare:   python benchmark.py --compare old.json new.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime
+
+import PIL
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+from render import (
+    DITHERS,
+    FRAME_HEIGHT,
+    FRAME_WIDTH,
+    DeviceProfile,
+    RenderedFrame,
+    apply_frame_diff,
+    decode_source,
+    dither,
+    draw_watermark,
+    fit_source,
+    frame_diff,
+    generate_xbm_string,
+    load_source,
+    pack_bits,
+    render_frame,
+)
+
+# Upload sizes for the decode benchmark (Telegram sends up to 2560 px)
+UPLOAD_SIZES = [(640, 480), (1280, 960), (2560, 1920)]
+
+# Routes every simulated device polls, in order, once per round
+POLLED_ROUTES = ["/get_last_md5", "/get_last_xbm"]
+
+# Diffs larger than this share of the binary frame are not sent (read as in anatoliy.py)
+FRAME_DIFF_MAX_RATIO = float(os.getenv("FRAME_DIFF_MAX_RATIO", "0.5"))
+
+
+def legacy_generate_xbm_string(img: Image.Image) -> str:
+    """The original per-pixel encoder, kept as the reference output."""
+    width, height = img.size
+    pixels = img.load()
+
+    xbm_data = []
+    byte_val = 0
+    bit_index = 0
+
+    for y in range(height):
+        for x in range(width):
+            pixel_value = pixels[x, y]  # 0 or 255
+            bit = 1 if pixel_value == 0 else 0
+            byte_val |= bit << bit_index
+            bit_index += 1
+            if bit_index == 8:
+                xbm_data.append(f"0x{byte_val:02x}")
+                byte_val = 0
+                bit_index = 0
+
+    if bit_index > 0:
+        xbm_data.append(f"0x{byte_val:02x}")
+
+    xbm_str = f"#define wifi_width {width}\n"
+    xbm_str += f"#define wifi_height {height}\n"
+    xbm_str += "static const unsigned char wifi_bits[] = {\n  "
+    xbm_str += ", ".join(xbm_data)
+    xbm_str += "\n};\n"
+
+    return xbm_str
+
+
+def legacy_draw_username(img: Image.Image, username: str) -> None:
+    """The original watermark, measured and drawn on every render, kept as the reference output."""
+    draw = ImageDraw.Draw(img)
+    font = ImageFont.load_default()
+    bbox = font.getmask(username).getbbox()
+    text_width, text_height = (bbox[2] - bbox[0], bbox[3] - bbox[1]) if bbox else (0, 0)
+    x = 1
+    y = img.height - text_height - 2
+    draw.rectangle((x - 1, y - 1, x + text_width + 2, y + text_height + 1), fill=1)
+    draw.text((x, y), username, fill=0, font=font)
+
+
+def random_frame(width: int, height: int, seed: int = 0) -> Image.Image:
+    """A dithered noise frame, the worst case for the encoder."""
+    rng = random.Random(seed)
+    noise = bytes(rng.randrange(256) for _ in range(width * height))
+    return Image.frombytes("L", (width, height), noise).convert("1", dither=Image.FLOYDSTEINBERG)
+
+
+def check_xbm_encoder() -> None:
+    """The bulk encoder must stay byte-for-byte identical to the legacy one."""
+    sizes = [(FRAME_WIDTH, FRAME_HEIGHT), (250, 122), (13, 7), (8, 1), (1, 1)]
+    for width, height in sizes:
+        for seed in range(3):
+            img = random_frame(width, height, seed)
+            assert generate_xbm_string(img) == legacy_generate_xbm_string(img), (width, height, seed)
+    for fill in (0, 1):
+        img = Image.new("1", (FRAME_WIDTH, FRAME_HEIGHT), fill)
+        assert generate_xbm_string(img) == legacy_generate_xbm_string(img), fill
+    print("generate_xbm_string: output identical to the legacy encoder")
+
+
+def check_frame_diff() -> None:
+    """Applying a diff to its base frame must give back the new frame."""
+
+    def frame(img: Image.Image) -> RenderedFrame:
+        bits = pack_bits(img)
+        return RenderedFrame(img.width, img.height, bits, "", b"", hashlib.md5(bits).hexdigest())
+
+    for width, height in [(FRAME_WIDTH, FRAME_HEIGHT), (250, 122), (13, 7)]:
+        base = random_frame(width, height)
+        for seed in range(1, 4):
+            edited = base.copy()
+            edited.paste(random_frame(width // 3 + 1, height // 4 + 1, seed), (width // 3, height // 2))
+            for new in (edited, random_frame(width, height, seed), base):
+                diff = frame_diff(frame(base), frame(new))
+                assert apply_frame_diff(pack_bits(base), diff) == pack_bits(new), (width, height, seed)
+    print("frame_diff: diffs apply back to the new frame")
+
+
+def bench(name: str, func, number: int) -> float:
+    """Time `func` and print the mean time per call in milliseconds."""
+    seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+    print(f"{name:<40} {seconds * 1000:8.3f} ms")
+    return seconds
+
+
+def bench_xbm_encoder() -> dict:
+    img = random_frame(FRAME_WIDTH, FRAME_HEIGHT)
+    legacy = bench("generate_xbm_string (legacy)", lambda: legacy_generate_xbm_string(img), 20)
+    bulk = bench("generate_xbm_string", lambda: generate_xbm_string(img), 500)
+    print(f"{'speedup':<40} {legacy / bulk:8.1f} x")
+    return {"legacy_ms": legacy * 1000, "ms": bulk * 1000}
+
+
+def check_watermark() -> None:
+    """The cached watermark label must paste exactly what the original drew."""
+    for username in ("bob", "a_rather_long_username_32_chars", "gjpqy", ""):
+        expected = random_frame(FRAME_WIDTH, FRAME_HEIGHT)
+        actual = expected.copy()
+        legacy_draw_username(expected, username)
+        draw_watermark(actual, username)
+        if ImageChops.difference(expected.convert("L"), actual.convert("L")).getbbox() is not None:
+            sys.exit(f"Watermark output differs from the original for {username!r}")
+    print("Watermark output matches the original")
+
+
+def bench_watermark() -> dict:
+    frame = random_frame(FRAME_WIDTH, FRAME_HEIGHT)
+    results = {}
+    for username in ("bob", "a_rather_long_username_32_chars"):
+        label = f"({len(username)} chars)"
+        legacy = bench(f"draw_username {label} (legacy)", lambda: legacy_draw_username(frame.copy(), username), 500)
+        cached = bench(f"draw_watermark {label}", lambda: draw_watermark(frame.copy(), username), 500)
+        print(f"{'speedup':<40} {legacy / cached:8.1f} x")
+        results[username] = {"legacy_ms": legacy * 1000, "ms": cached * 1000}
+    return results
+
+
+def bench_frame_diff() -> dict:
+    """
+    Diff size for a realistic edit, per dither mode: an upload and a copy with
+    a 200x200 px box drawn on it, both through render_frame. Error diffusion
+    spreads any change over the rest of the frame, so only some modes give
+    diffs small enough to be sent (see FRAME_DIFF_MAX_RATIO).
+    """
+    upload = {"username": "bob", "caption": "a meme", "date": "2024-01-01"}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        base_path, edited_path = os.path.join(tmp, "base.jpg"), os.path.join(tmp, "edited.jpg")
+        make_upload(base_path, 1280, 960)
+        with Image.open(base_path) as img:
+            ImageDraw.Draw(img).rectangle((540, 380, 739, 579), fill=(255, 255, 255))
+            img.save(edited_path, quality=87)
+        for method in DITHERS:
+            profile = DeviceProfile("bench", FRAME_WIDTH, FRAME_HEIGHT, dither=method)
+            base, new = render_frame(base_path, upload, profile), render_frame(edited_path, upload, profile)
+            diff = frame_diff(base, new)
+            assert apply_frame_diff(base.bits, diff) == new.bits, method
+            ratio = len(diff) / len(new.binary)
+            sent = "diff" if ratio <= FRAME_DIFF_MAX_RATIO else "full frame"
+            print(f"{'diff ' + method:<40} {len(diff):8d} B   {ratio:6.1%} of the frame, sends the {sent}")
+            results[method] = {"diff_bytes": len(diff), "ratio": ratio}
+    return results
+
+
+def bench_pipeline() -> dict:
+    """Resize and dither per upload size, and the whole render_frame with and without the watermark."""
+    size = (FRAME_WIDTH, FRAME_HEIGHT)
+    profile = DeviceProfile("default", FRAME_WIDTH, FRAME_HEIGHT)
+    plain = DeviceProfile("plain", FRAME_WIDTH, FRAME_HEIGHT, watermark=False)
+    upload = {"username": "bob", "caption": "a meme", "date": "2024-01-01"}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for width, height in UPLOAD_SIZES:
+            path = os.path.join(tmp, f"{width}x{height}.jpg")
+            make_upload(path, width, height)
+            decoded = decode_source(path, size)
+            resized = fit_source(decoded, size, "stretch", "lanczos")
+            label = f"{width}x{height}"
+            case = {
+                "resize_ms": bench(
+                    f"resize lanczos {label}", lambda: fit_source(decoded, size, "stretch", "lanczos"), 50
+                ) * 1000
+            }
+            for method in DITHERS:
+                case[f"dither_{method}_ms"] = bench(f"dither {method}", lambda: dither(resized, method), 20) * 1000
+            case["render_frame_ms"] = bench(
+                f"render_frame {label}", lambda: render_frame(path, upload, profile), 10
+            ) * 1000
+            case["render_frame_no_watermark_ms"] = bench(
+                f"render_frame {label} (no watermark)", lambda: render_frame(path, upload, plain), 10
+            ) * 1000
+            results[label] = case
+    return results
+
+
+def make_upload(path: str, width: int, height: int) -> None:
+    """A photo-like JPEG: a gradient with noise, saved at Telegram's quality."""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 8)
+    Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT))).save(
+        path, quality=87
+    )
+
+
+def legacy_decode(image_path: str) -> None:
+    """The original decode path: full-resolution decode, then a NEAREST resize."""
+    img = Image.open(image_path)
+    img.resize((FRAME_WIDTH, FRAME_HEIGHT), Image.Resampling.NEAREST)
+
+
+def draft_decode(image_path: str, resample: str, fit: str) -> None:
+    load_source(image_path, (FRAME_WIDTH, FRAME_HEIGHT), fit, resample)
+
+
+def peak_rss_kib() -> int:
+    """
+    Peak resident memory of this process in KiB. Prefers VmHWM on Linux:
+    ru_maxrss of a spawned child also counts the parent it was forked from.
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(func, args: tuple, queue: multiprocessing.Queue) -> None:
+    """Run once in a fresh process and report (seconds, peak RSS growth in KiB)."""
+    # Warm up Pillow's plugins on a tiny image, so only the decode itself is measured
+    Image.new("RGB", (8, 8)).resize((4, 4))
+    baseline = peak_rss_kib()
+    started = time.perf_counter()
+    func(*args)
+    elapsed = time.perf_counter() - started
+    queue.put((elapsed, peak_rss_kib() - baseline))
+
+
+def measure(func, *args) -> tuple:
+    """Time `func` and measure its peak memory in a fresh (spawned) process."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure, args=(func, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def bench_decode() -> dict:
+    print(f"{'upload':<12} {'path':<28} {'time':>10} {'peak memory':>14}")
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for width, height in UPLOAD_SIZES:
+            path = os.path.join(tmp, f"{width}x{height}.jpg")
+            make_upload(path, width, height)
+            cases = [
+                ("legacy full decode", legacy_decode, (path,)),
+                ("draft + nearest", draft_decode, (path, "nearest", "stretch")),
+                ("draft + lanczos", draft_decode, (path, "lanczos", "stretch")),
+                ("draft + lanczos crop", draft_decode, (path, "lanczos", "crop")),
+            ]
+            for name, func, args in cases:
+                elapsed, peak_kib = measure(func, *args)
+                size = f"{width}x{height}"
+                print(f"{size:<12} {name:<28} {elapsed * 1000:7.1f} ms {peak_kib / 1024:10.1f} MiB")
+                results[f"{size} {name}"] = {"ms": elapsed * 1000, "peak_mib": peak_kib / 1024}
+    return results
+
+
+#
+# Load test: simulated devices polling the app through its ASGI interface
+#
+async def asgi_get(app, path: str, headers: list) -> int:
+    """Send one GET straight to the ASGI app (no sockets, no HTTP client); returns the status."""
+    path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": query.encode(),
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 0),
+        "server": ("benchmark", 80),
+    }
+    status = 0
+
+    async def receive() -> dict:
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message: dict) -> None:
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    return status
+
+
+async def simulate_devices(app, devices: int, rounds: int) -> dict:
+    """
+    `devices` concurrent pollers, each requesting POLLED_ROUTES `rounds` times.
+    Latencies and throughput count successful responses (200 or 304) only;
+    failures are counted per route, so a run full of fast 503s can't pass
+    for a fast run.
+    """
+    latencies = {route: [] for route in POLLED_ROUTES}
+    errors = {route: 0 for route in POLLED_ROUTES}
+
+    async def device(n: int) -> None:
+        headers = [(b"x-device-id", f"bench-{n}".encode())]
+        for _ in range(rounds):
+            for route in POLLED_ROUTES:
+                started = time.perf_counter()
+                status = await asgi_get(app, route, headers)
+                if status in (200, 304):
+                    latencies[route].append(time.perf_counter() - started)
+                else:
+                    errors[route] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(device(n) for n in range(devices)))
+    elapsed = time.perf_counter() - started
+
+    results = {"devices": devices, "rounds": rounds, "errors": sum(errors.values()), "seconds": elapsed}
+    total = 0
+    for route, samples in latencies.items():
+        requests = len(samples) + errors[route]
+        total += len(samples)
+        results[route] = {
+            "requests": requests,
+            "errors": errors[route],
+            "error_rate": errors[route] / requests,
+            "rps": len(samples) / elapsed,
+        }
+        if len(samples) < 2:
+            print(f"{route:<20} {requests:>7} req   {errors[route]} errors")
+            continue
+        quantiles = statistics.quantiles(samples, n=100)
+        results[route]["p50_ms"] = quantiles[49] * 1000
+        results[route]["p99_ms"] = quantiles[98] * 1000
+        print(
+            f"{route:<20} {requests:>7} req   p50 {quantiles[49] * 1000:7.3f} ms"
+            f"   p99 {quantiles[98] * 1000:7.3f} ms   {errors[route]} errors"
+        )
+    results["rps"] = total / elapsed
+    print(f"{'total':<20} {total:>7} ok    {total / elapsed:9.0f} req/s   {results['errors']} errors")
+    return results
+
+
+def load_test(devices: int, rounds: int) -> dict:
+    """
+    Import the app in a scratch directory with the bot disabled, so nothing
+    touches the real data or the network; only the device routes are exercised.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        os.environ["BOT_MODE"] = "off"
+        os.environ["DB_FILE"] = os.path.join(tmp, "anatoliy.db")
+        try:
+            os.makedirs("data")
+            make_upload(os.path.join("data", "24-01-01-12-00-00-bench-meme.jpg"), 1280, 960)
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import anatoliy
+
+            async def run() -> dict:
+                anatoliy.executor.start()
+                try:
+                    # Warm-up: render the frame and fill the caches once
+                    for route in POLLED_ROUTES:
+                        await asgi_get(anatoliy.app, route, [])
+                    return await simulate_devices(anatoliy.app, devices, rounds)
+                finally:
+                    anatoliy.executor.shutdown()
+
+            return asyncio.run(run())
+        finally:
+            os.chdir(cwd)
+
+
+#
+# Results
+#
+def flatten(results: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+def compare(old_path: str, new_path: str) -> None:
+    """Print every number of two result files side by side."""
+    with open(old_path) as file:
+        old = flatten(json.load(file)["results"])
+    with open(new_path) as file:
+        new = flatten(json.load(file)["results"])
+    for key in sorted(old.keys() & new.keys()):
+        ratio = f"{new[key] / old[key]:7.2f} x" if old[key] else ""
+        print(f"{key:<60} {old[key]:12.3f} {new[key]:12.3f} {ratio}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=50, help="simulated devices in the load test")
+    parser.add_argument("--rounds", type=int, default=20, help="polls per device in the load test")
+    parser.add_argument("--output", help="JSON file for the results (default: benchmark-<time>.json)")
+    parser.add_argument("--skip-decode", action="store_true", help="skip the (slow) decode memory benchmark")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    check_xbm_encoder()
+    check_frame_diff()
+    check_watermark()
+    results = {
+        "xbm_encoder": bench_xbm_encoder(),
+        "watermark": bench_watermark(),
+        "frame_diff": bench_frame_diff(),
+        "pipeline": bench_pipeline(),
+    }
+    if not args.skip_decode:
+        results["decode"] = bench_decode()
+    results["load"] = load_test(args.devices, args.rounds)
+
+    output = args.output or f"benchmark-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as file:
+        json.dump(
+            {
+                "created_at": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "pillow": PIL.__version__,
+                "cpus": os.cpu_count(),
+                "results": results,
+            },
+            file,
+            indent=2,
+        )
+    print(f"Results saved to {output}")
+    if results["load"]["errors"]:
+        sys.exit(f"Load test failed: {results['load']['errors']} requests were not answered with 200 or 304")
+
+
+if __name__ == "__main__":
+    main()
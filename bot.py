@@ -0,0 +1,481 @@
+"""
+The Telegram bot: commands, photo uploads, Wi-Fi sharing and upload notifications.
+
+Only the process running the bot imports this module (and python-telegram-bot),
+so the device routes start without it:
+  - BOT_MODE=webhook: one worker of the web app, whichever holds the bot lock,
+    runs the bot (see anatoliy.claim_bot). Webhook updates that reach other
+    workers are relayed to it through the database.
+  - BOT_MODE=polling: `python bot.py` runs the bot in its own process with
+    long polling, and the web app has no /telegram route.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import signal
+import tempfile
+from datetime import datetime
+
+from starlette.concurrency import run_in_threadpool
+from telegram import (
+    InlineKeyboardMarkup,
+    KeyboardButton,
+    Update,
+    InlineKeyboardButton,
+    ReplyKeyboardMarkup,
+)
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    MessageHandler,
+    CallbackQueryHandler,
+    filters,
+    ContextTypes,
+    ConversationHandler,
+)
+
+from anatoliy import (
+    BOT_LOCK_FILE,
+    DEVICE_PROFILES,
+    IMAGE_DIR,
+    executor,
+    get_rendered_frame,
+    notify_new_frame,
+    set_latest_image,
+    storage,
+    try_bot_lock,
+)
+from broadcast import Broadcaster
+
+WIFI_NAME, WIFI_PASSWORD = range(2)
+
+TOKEN = os.getenv("TOKEN")
+DOMAIN_NAME = os.getenv("DOMAIN_NAME")
+
+# Texts from .env
+WELCOME_TEXT = os.getenv("WELCOME_TEXT", "Welcome! Your user ID has been registered.")
+NOTIFY_PROMPT = os.getenv("NOTIFY_PROMPT", "Do you want to notify all users about this upload?")
+UPDATE_TEXT = os.getenv("UPDATE_TEXT", "A new image has been uploaded!")
+WIFI_CONNECT_TEXT = os.getenv("WIFI_CONNECT_TEXT", "Thank you for sharing your network!")
+ABOUT_TEXT = os.getenv("ABOUT_TEXT")
+DUPLICATE_TEXT = os.getenv("DUPLICATE_TEXT", "This image has already been uploaded.")
+
+# Upload notifications: parallel sends, messages per second overall,
+# seconds between messages to the same chat, retries of transient errors
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1"))
+BROADCAST_RETRIES = int(os.getenv("BROADCAST_RETRIES", "3"))
+
+# Photo ingestion: parallel downloads, and the longest caption kept in a filename
+INGEST_CONCURRENCY = int(os.getenv("INGEST_CONCURRENCY", "4"))
+CAPTION_MAX_LENGTH = int(os.getenv("CAPTION_MAX_LENGTH", "64"))
+
+# How often the bot worker picks up updates relayed by other workers (seconds)
+BOT_RELAY_INTERVAL = float(os.getenv("BOT_RELAY_INTERVAL", "0.5"))
+
+logger = logging.getLogger(__name__)
+
+# Initialize the Telegram bot application
+application = Application.builder().token(TOKEN).build()
+
+# Background queue for upload notifications, started in start_bot
+broadcaster = None
+
+# Bounds the photo downloads running at once
+ingest_semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+
+# Moves updates stored by other workers into the update queue (webhook mode)
+relay_task = None
+
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /start command and register the user, then show the main menu."""
+    user_id = update.effective_user.id
+    await run_in_threadpool(register_user, user_id)
+    await update.message.reply_text(WELCOME_TEXT)
+    await show_main_menu(update, context)  # Show the main menu after welcome
+
+
+async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle photo uploads. The photo is downloaded in a background task, so the
+    update is handled at once; the task prompts the user to notify all other
+    users after saving the photo.
+    """
+    context.application.create_task(
+        ingest_photo(update.message, update.effective_user), update=update
+    )
+
+
+def safe_caption(caption: str) -> str:
+    """
+    The caption as a filename part: every run of characters other than letters,
+    digits and "_" becomes "_" (so no path separators, dots or the "-" field
+    separator), cut to CAPTION_MAX_LENGTH.
+    """
+    safe = re.sub(r"\W+", "_", caption).strip("_")[:CAPTION_MAX_LENGTH]
+    return safe or "image"
+
+
+def hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(64 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def store_upload(tmp_path: str, filename: str, user_id: int, username: str, caption: str,
+                 file_unique_id: str, content_hash: str) -> str | None:
+    """
+    Record a downloaded photo and rename it into IMAGE_DIR. Returns its path,
+    or None if the same photo is already stored. The catalog picks the final
+    name (see Storage.add_image), so concurrent uploads never share one.
+    """
+    stem, ext = os.path.splitext(filename)
+    n = 1
+    # Files not cataloged yet (copied in by hand) also keep their name
+    while os.path.exists(os.path.join(IMAGE_DIR, filename)):
+        n += 1
+        filename = f"{stem}_{n}{ext}"
+    filename = storage.add_image(filename, user_id, username, caption, file_unique_id, content_hash)
+    if filename is None:
+        return None
+    file_path = os.path.join(IMAGE_DIR, filename)
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+async def ingest_photo(message, user) -> None:
+    """
+    Download a photo, skip it if it was uploaded before (same Telegram
+    file_unique_id or same content), then render it and prompt the user.
+    """
+    photo = message.photo[-1]
+
+    # Build the filename: yy-mm-dd-hh-mm-ss-username-img_name.jpg
+    now_str = datetime.now().strftime("%y-%m-%d-%H-%M-%S")
+    username_str = user.username if user.username else str(user.id)
+    caption = message.caption or "image"
+    filename = f"{now_str}-{username_str}-{safe_caption(caption)}.jpg"
+
+    async with ingest_semaphore:
+        if await run_in_threadpool(storage.has_image, photo.file_unique_id):
+            await message.reply_text(DUPLICATE_TEXT)
+            return
+
+        # Download next to the images (same filesystem, so the rename is atomic);
+        # the .part suffix keeps it out of the latest-image index
+        fd, tmp_path = tempfile.mkstemp(prefix=".", suffix=".part", dir=IMAGE_DIR)
+        os.close(fd)
+        try:
+            file_obj = await photo.get_file()
+            await file_obj.download_to_drive(tmp_path)
+            content_hash = await run_in_threadpool(hash_file, tmp_path)
+            file_path = await run_in_threadpool(
+                store_upload, tmp_path, filename, user.id, username_str, caption,
+                photo.file_unique_id, content_hash,
+            )
+        except Exception as e:
+            logger.error(f"Failed to store upload {filename}: {e}")
+            await message.reply_text("Не получилось сохранить картинку, попробуй ещё раз.")
+            return
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    if file_path is None:
+        logger.info(f"Skipped duplicate upload {filename}")
+        await message.reply_text(DUPLICATE_TEXT)
+        return
+    set_latest_image(file_path)
+
+    # Render the device frame once, so polls only serve the stored artifacts
+    try:
+        await asyncio.gather(
+            *(get_rendered_frame(file_path, profile) for profile in DEVICE_PROFILES.values())
+        )
+    except Exception as e:
+        logger.error(f"Failed to render {file_path}: {e}")
+    await notify_new_frame()
+
+    # Prompt user whether to notify everyone
+    keyboard = [
+        [
+            InlineKeyboardButton("Давай", callback_data="notify_yes"),
+            InlineKeyboardButton("Ну не", callback_data="notify_no"),
+        ]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    # Send the notification prompt
+    await message.reply_text(NOTIFY_PROMPT, reply_markup=reply_markup)
+
+
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle all button presses (InlineKeyboardButton callbacks)."""
+    query = update.callback_query
+    await query.answer()
+
+    if query.data == "upload_image":
+        await query.message.reply_text("Просто загрузи картинку.")
+
+    elif query.data == "notify_yes":
+        # Delete the original message with buttons
+        await query.message.delete()
+
+        # Broadcast the update text to all users in the background
+        broadcaster.enqueue(UPDATE_TEXT)
+
+    elif query.data == "notify_no":
+        # Delete the original message with buttons
+        await query.message.delete()
+        # Optionally respond with a "not notified" text
+
+    # (share_wifi is handled by the ConversationHandler)
+
+
+async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle plain text messages (non-photo, non-command)."""
+    user_text = update.message.text
+    logger.info(f"User sent text message: {user_text}")
+    await update.message.reply_text(f"You said: {user_text}")
+
+
+def register_user(user_id: int) -> None:
+    """Register a new user in the database."""
+    if storage.register_user(user_id):
+        logger.info(f"Registered new user: {user_id}")
+    else:
+        logger.info(f"User {user_id} is already registered.")
+
+
+def unregister_user(user_id: int) -> None:
+    """Remove a user who blocked the bot from the database."""
+    storage.remove_user(user_id)
+    logger.info(f"Unregistered user: {user_id}")
+
+
+async def share_wifi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Initiate the process of sharing WiFi."""
+    if update.callback_query:
+        # If triggered from a button, acknowledge and edit the message
+        await update.callback_query.answer()
+        await update.callback_query.message.delete()
+        await update.callback_query.message.reply_text("Введите имя сети WiFi:")
+    elif update.message:
+        # If triggered from a command or keyboard button
+        await update.message.reply_text("Введите имя сети WiFi:")
+    return WIFI_NAME
+
+
+async def handle_wifi_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handle WiFi name input."""
+    context.user_data["wifi_name"] = update.message.text
+    await update.message.reply_text("Теперь введите пароль для WiFi:")
+    return WIFI_PASSWORD
+
+
+async def handle_wifi_password(
+    update: Update, context: ContextTypes.DEFAULT_TYPE
+) -> int:
+    """Handle WiFi password input."""
+    wifi_name = context.user_data.get("wifi_name")
+    wifi_password = update.message.text
+
+    if not wifi_name:
+        await update.message.reply_text("Произошла ошибка. Пожалуйста, начните снова.")
+        return ConversationHandler.END
+
+    try:
+        await run_in_threadpool(storage.add_network, wifi_name, wifi_password)
+
+        await update.message.reply_text(
+            f"WiFi '{wifi_name}' успешно добавлен.\n\n{WIFI_CONNECT_TEXT}"
+        )
+    except Exception as e:
+        logger.error(f"Failed to save WiFi network: {e}")
+        await update.message.reply_text("Произошла ошибка при сохранении WiFi. Попробуйте ещё раз.")
+
+    # Show the main menu again after completion
+    await show_main_menu(update, context)
+    return ConversationHandler.END
+
+
+async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the main menu with available actions using ReplyKeyboardMarkup."""
+    keyboard = [
+        [KeyboardButton("Загрузить мем"), KeyboardButton("Добавить Wi-Fi")],
+        [KeyboardButton("Об Анатолии Васильевиче")],
+    ]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+    await update.message.reply_text("Выберите действие:", reply_markup=reply_markup)
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send a message when the command /help is issued."""
+    await update.message.reply_text(ABOUT_TEXT)
+
+
+async def handle_main_menu_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle user selections from the main menu."""
+    user_selection = update.message.text.lower()
+
+    if user_selection == "загрузить мем":
+        await update.message.reply_text("Просто загрузи картинку как ты обычно делаешь в Телеграме.")
+    elif user_selection == "добавить wi-fi":
+        await share_wifi(update, context)
+    elif user_selection == "об анатолии васильевиче":
+        await help_command(update, context)
+    # else:
+    #     await update.message.reply_text("Не понял, попробуй еще раз.")
+
+
+async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Handle cancellation of the conversation."""
+    if update.callback_query:
+        await update.callback_query.answer()
+        await update.callback_query.message.reply_text("Разговор отменён.")
+    else:
+        await update.message.reply_text("Разговор отменён.")
+    return ConversationHandler.END
+
+
+#
+# Running the bot
+#
+def add_handlers() -> None:
+    """Register all handlers, once."""
+    if application.handlers:
+        return
+
+    wifi_conversation_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler("share_wifi", share_wifi),
+            CallbackQueryHandler(share_wifi, pattern="share_wifi"),
+            MessageHandler(filters.Regex("^Добавить Wi-Fi$"), share_wifi),
+        ],
+        states={
+            WIFI_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_wifi_name)],
+            WIFI_PASSWORD: [
+                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_wifi_password)
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel_conversation)],
+        allow_reentry=True,
+    )
+    application.add_handler(wifi_conversation_handler)
+
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    application.add_handler(
+        CallbackQueryHandler(button_handler, pattern="^(?!share_wifi).*")
+    )
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_main_menu_selection)
+    )
+
+
+async def start_bot() -> None:
+    """Initialize and start the application, and start the notification queue."""
+    global broadcaster
+
+    add_handlers()
+    await application.initialize()
+    await application.start()
+
+    broadcaster = Broadcaster(
+        application.bot,
+        storage.get_all_user_ids,
+        unregister_user,
+        concurrency=BROADCAST_CONCURRENCY,
+        rate=BROADCAST_RATE,
+        chat_interval=BROADCAST_CHAT_INTERVAL,
+        max_retries=BROADCAST_RETRIES,
+    )
+    broadcaster.start()
+
+
+async def stop_bot() -> None:
+    if broadcaster is not None:
+        await broadcaster.stop()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+
+
+def enqueue_update(data: dict) -> None:
+    """Queue a webhook update for the application's update processor."""
+    application.update_queue.put_nowait(Update.de_json(data, application.bot))
+
+
+async def relay_updates() -> None:
+    """Feed updates that other workers received and stored into the update queue."""
+    while True:
+        await asyncio.sleep(BOT_RELAY_INTERVAL)
+        try:
+            for data in await run_in_threadpool(storage.take_updates):
+                enqueue_update(data)
+        except Exception as e:
+            logger.error(f"Failed to relay stored updates: {e}")
+
+
+async def start_webhook() -> None:
+    """
+    Start the bot in this web worker (BOT_MODE=webhook). The webhook is only
+    registered if Telegram does not have it already.
+    """
+    global relay_task
+
+    await start_bot()
+    try:
+        webhook_url = f"{DOMAIN_NAME}/telegram"
+        info = await application.bot.get_webhook_info()
+        if info.url != webhook_url:
+            await application.bot.set_webhook(webhook_url)
+            logger.info(f"Webhook set to {webhook_url}")
+    except Exception:
+        await stop_bot()
+        raise
+    relay_task = asyncio.create_task(relay_updates())
+
+
+async def stop_webhook() -> None:
+    """
+    Stop the bot in this worker. The webhook stays registered: the other
+    workers keep accepting updates until one of them takes over the bot.
+    """
+    if relay_task is not None:
+        relay_task.cancel()
+    await stop_bot()
+
+
+async def run_polling() -> None:
+    """Run the bot with long polling until SIGINT or SIGTERM (BOT_MODE=polling)."""
+    executor.start()
+    await start_bot()
+    # Polling replaces (deletes) any registered webhook
+    await application.updater.start_polling()
+    logger.info("Bot is polling for updates")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+    await application.updater.stop()
+    await stop_bot()
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    # Only one process may run the bot, whether a web worker or this one
+    lock = try_bot_lock()
+    if lock is None:
+        raise SystemExit(f"The bot is already running in another process ({BOT_LOCK_FILE} is locked)")
+    asyncio.run(run_polling())
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Callable
+
+from starlette.concurrency import run_in_threadpool
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """
+    Spaces out sends to stay under Telegram's limits: a global rate across all
+    chats, a minimum interval per chat, and a global pause after a RetryAfter.
+    """
+
+    def __init__(self, rate: float, chat_interval: float) -> None:
+        self.interval = 1.0 / rate
+        self.chat_interval = chat_interval
+        self.next_slot = 0.0
+        self.next_chat_slot: dict[int, float] = {}
+        self.paused_until = 0.0
+
+    async def acquire(self, chat_id: int) -> None:
+        """Wait until a message to `chat_id` may be sent."""
+        now = time.monotonic()
+        # Reserve the slot before sleeping, so concurrent senders queue up behind it
+        slot = max(now, self.next_slot, self.paused_until, self.next_chat_slot.get(chat_id, 0.0))
+        self.next_slot = slot + self.interval
+        self.next_chat_slot[chat_id] = slot + self.chat_interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds: float) -> None:
+        """Stop all sends for `seconds` (Telegram answered with RetryAfter)."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    """
+    Background queue that sends a text to every registered user with bounded
+    concurrency, retries transient failures and prunes users who blocked the
+    bot. Callers only enqueue, so the webhook request returns immediately.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        get_user_ids: Callable[[], list],
+        remove_user: Callable[[int], None],
+        concurrency: int = 8,
+        rate: float = 25.0,
+        chat_interval: float = 1.0,
+        max_retries: int = 3,
+    ) -> None:
+        self.bot = bot
+        self.get_user_ids = get_user_ids
+        self.remove_user = remove_user
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate, chat_interval)
+        self.max_retries = max_retries
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+        # Metrics of the most recent broadcasts, newest last
+        self.history: deque = deque(maxlen=50)
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is None:
+            return
+        if not self.queue.empty():
+            logger.warning(f"Dropping {self.queue.qsize()} queued broadcasts on shutdown")
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+    def enqueue(self, text: str) -> None:
+        """Queue a broadcast of `text` to all users."""
+        self.queue.put_nowait(text)
+        logger.info(f"Broadcast queued ({self.queue.qsize()} pending)")
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    async def run(self) -> None:
+        while True:
+            text = await self.queue.get()
+            try:
+                await self.broadcast(text)
+            except Exception as e:
+                logger.error(f"Broadcast failed: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def broadcast(self, text: str) -> dict:
+        """Send `text` to every user and record the outcome."""
+        stats = {
+            "started_at": time.time(),
+            "duration": 0.0,
+            "recipients": 0,
+            "sent": 0,
+            "failed": 0,
+            "throttled": 0,
+            "retried": 0,
+            "pruned": 0,
+        }
+        started = time.monotonic()
+        user_ids = await run_in_threadpool(self.get_user_ids)
+        stats["recipients"] = len(user_ids)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send_one(chat_id: int) -> None:
+            async with semaphore:
+                await self.send(chat_id, text, stats)
+
+        await asyncio.gather(*(send_one(chat_id) for chat_id in user_ids))
+
+        stats["duration"] = time.monotonic() - started
+        self.history.append(stats)
+        logger.info(
+            f"Broadcast to {stats['recipients']} users in {stats['duration']:.2f}s: "
+            f"{stats['sent']} sent, {stats['failed']} failed, "
+            f"{stats['throttled']} throttled, {stats['pruned']} pruned"
+        )
+        return stats
+
+    async def send(self, chat_id: int, text: str, stats: dict) -> None:
+        """Send one message, honouring rate limits and retrying transient errors."""
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                stats["retried"] += 1
+            await self.limiter.acquire(chat_id)
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                stats["sent"] += 1
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                stats["throttled"] += 1
+                logger.warning(f"Flood control while sending to {chat_id}, pausing {retry_after}s")
+                self.limiter.pause(float(retry_after))
+            except Forbidden as e:
+                # The user blocked the bot or deleted their account
+                await self.prune(chat_id, e, stats)
+                return
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    await self.prune(chat_id, e, stats)
+                else:
+                    logger.error(f"Failed to send notification to {chat_id}: {e}")
+                    stats["failed"] += 1
+                return
+            except NetworkError as e:
+                # Includes TimedOut: back off and try again
+                logger.warning(f"Transient error sending to {chat_id} (attempt {attempt + 1}): {e}")
+                if attempt < self.max_retries:
+                    await asyncio.sleep(2**attempt)
+            except Exception as e:
+                logger.error(f"Failed to send notification to {chat_id}: {e}")
+                stats["failed"] += 1
+                return
+
+        logger.error(f"Giving up on notification to {chat_id} after {self.max_retries} retries")
+        stats["failed"] += 1
+
+    async def prune(self, chat_id: int, error: Exception, stats: dict) -> None:
+        logger.info(f"Removing user {chat_id}, who can't be reached anymore: {error}")
+        stats["pruned"] += 1
+        try:
+            await run_in_threadpool(self.remove_user, chat_id)
+        except Exception as e:
+            logger.error(f"Failed to remove user {chat_id}: {e}")
@@ -0,0 +1,108 @@
+import math
+import random
+import time
+
+# Longer device IDs are ignored, and longer firmware versions cut, so header
+# values cannot grow the registry's memory or the database
+MAX_DEVICE_ID_LENGTH = 64
+
+
+class DeviceRegistry:
+    """
+    The devices that identify themselves with a header (e.g. X-Device-Id),
+    kept in memory: last-seen time, firmware version and the hash of the frame
+    last served to them. Requests only update the dict; take_changes() hands
+    the changed devices to a periodic flush, so the database sees one batch
+    instead of a write per poll. At most `max_devices` are tracked: the dict
+    is kept in last-seen order, and a new device replaces the one seen least
+    recently, so random IDs can neither grow it nor lock real boards out.
+    """
+
+    def __init__(self, max_devices: int = 1000) -> None:
+        self.max_devices = max_devices
+        self.devices: dict[str, dict] = {}
+        self.changed: set = set()
+
+    def load(self, devices: list) -> None:
+        """
+        Start from stored devices (dicts with device_id, firmware, md5 and
+        last_seen as Unix time), most recently seen first.
+        """
+        for device in reversed(devices[: self.max_devices]):
+            self.devices.setdefault(device["device_id"], {key: value for key, value in device.items()})
+
+    def seen(self, device_id: str, firmware: str | None = None, md5: str | None = None) -> None:
+        if len(device_id) > MAX_DEVICE_ID_LENGTH:
+            return
+        device = self.devices.pop(device_id, None)
+        if device is None:
+            if len(self.devices) >= self.max_devices:
+                evicted = next(iter(self.devices))
+                del self.devices[evicted]
+                self.changed.discard(evicted)
+            device = {"device_id": device_id, "firmware": None, "md5": None}
+        # Re-inserted, so the dict stays ordered by last-seen time
+        self.devices[device_id] = device
+        device["last_seen"] = time.time()
+        if firmware is not None:
+            device["firmware"] = firmware[:MAX_DEVICE_ID_LENGTH]
+        if md5 is not None:
+            device["md5"] = md5
+        self.changed.add(device_id)
+
+    def take_changes(self) -> list:
+        """Copies of the devices changed since the last call."""
+        changes = [dict(self.devices[device_id]) for device_id in self.changed]
+        self.changed.clear()
+        return changes
+
+    def last_seen(self) -> dict:
+        """{(device_id,): last-seen Unix time}, for a metrics gauge."""
+        return {(device_id,): device["last_seen"] for device_id, device in self.devices.items()}
+
+
+class DeviceMiddleware:
+    """ASGI middleware recording every request that carries `device_header` in `registry`."""
+
+    def __init__(self, app, registry: DeviceRegistry, device_header: str, firmware_header: str) -> None:
+        self.app = app
+        self.registry = registry
+        self.device_header = device_header.lower().encode("latin-1")
+        self.firmware_header = firmware_header.lower().encode("latin-1")
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] == "http":
+            device, firmware = None, None
+            for name, value in scope["headers"]:
+                if name == self.device_header:
+                    device = value.decode("latin-1")
+                elif name == self.firmware_header:
+                    firmware = value.decode("latin-1")
+            if device:
+                self.registry.seen(device, firmware)
+        await self.app(scope, receive, send)
+
+
+def next_poll_after(
+    since_upload: float,
+    min_interval: float,
+    max_interval: float,
+    activity_ratio: float,
+    jitter: float,
+    next_change_in: float | None = None,
+) -> int:
+    """
+    Seconds a device should wait before polling again. Right after an upload
+    devices poll every `min_interval` (more uploads tend to follow); the
+    interval grows by `activity_ratio` of the time since the last upload, up
+    to `max_interval` once things are idle. If the frame is known to change
+    sooner (rotation), the hint lands just after that change instead. Hints
+    are spread by +-`jitter` (a fraction), so devices that start together, e.g.
+    after a restart, drift apart instead of polling in lock-step.
+    """
+    interval = min(max_interval, max(min_interval, since_upload * activity_ratio))
+    if next_change_in is not None and next_change_in < interval:
+        hint = next_change_in + random.uniform(0, jitter * interval)
+    else:
+        hint = interval * random.uniform(1 - jitter, 1 + jitter)
+    return max(1, math.ceil(hint))
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Hashable
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """Raised when too many renders are already queued; the caller should answer 503."""
+
+
+class ExecutionLayer:
+    """
+    Keeps blocking work off the event loop: CPU-bound rendering runs in a
+    process pool, file and database I/O in a thread pool.
+
+    At most `max_pending` render jobs may be queued or running at once;
+    beyond that new renders are refused with Overloaded instead of piling up.
+    I/O jobs are short lookups and only queue for the thread pool, so cached
+    polls are never refused. Concurrent render jobs with the same key share
+    a single execution. If a render process dies (e.g. the OOM killer), the
+    process pool is replaced and the job retried once.
+    """
+
+    def __init__(self, render_workers: int, io_workers: int, max_pending: int) -> None:
+        self.render_workers = render_workers
+        self.io_workers = io_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.inflight: dict[Hashable, asyncio.Future] = {}
+        self.io_pool: ThreadPoolExecutor | None = None
+        self.render_pool: Executor | None = None
+
+    def start(self) -> None:
+        self.io_pool = ThreadPoolExecutor(self.io_workers, thread_name_prefix="io")
+        if self.render_workers > 0:
+            self.render_pool = self.start_render_processes()
+        else:
+            # Small deployments: render in the thread pool instead of separate processes
+            self.render_pool = self.io_pool
+
+    def start_render_processes(self) -> ProcessPoolExecutor:
+        # Processes are started on demand, while the I/O threads may hold
+        # locks (logging, sqlite): fork them from a clean server process
+        context = multiprocessing.get_context("forkserver")
+        return ProcessPoolExecutor(self.render_workers, mp_context=context)
+
+    def shutdown(self) -> None:
+        if self.render_pool is not None and self.render_pool is not self.io_pool:
+            self.render_pool.shutdown(wait=False, cancel_futures=True)
+        if self.io_pool is not None:
+            self.io_pool.shutdown(wait=False, cancel_futures=True)
+        self.io_pool = self.render_pool = None
+
+    async def submit(self, pool: Executor | None, func: Callable, *args: Any) -> Any:
+        # Without start() (e.g. scripts importing the app) fall back to the default executor
+        return await asyncio.get_running_loop().run_in_executor(pool, func, *args)
+
+    async def submit_render(self, func: Callable, *args: Any) -> Any:
+        if self.pending >= self.max_pending:
+            raise Overloaded(f"{self.pending} renders pending")
+        self.pending += 1
+        pool = self.render_pool
+        try:
+            try:
+                return await self.submit(pool, func, *args)
+            except BrokenProcessPool:
+                # Every job running in the pool fails at once: only the first replaces it
+                if self.render_pool is pool:
+                    logger.error("A render process died, restarting the render processes")
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.render_pool = self.start_render_processes()
+                return await self.submit(self.render_pool, func, *args)
+        finally:
+            self.pending -= 1
+
+    async def run_io(self, func: Callable, *args: Any) -> Any:
+        """Run blocking file or database I/O in the thread pool."""
+        return await self.submit(self.io_pool, func, *args)
+
+    async def run_render(
+        self,
+        key: Hashable,
+        func: Callable,
+        *args: Any,
+        on_done: Callable | None = None,
+        then: Callable | None = None,
+    ) -> Any:
+        """
+        Run a CPU-bound render in the process pool. `func` must be picklable
+        (a module-level function). Callers passing the same `key` while a job
+        is running wait for that job instead of starting another one.
+        `on_done(result)` runs once per job that succeeds, not once per caller;
+        so does `then(result)`, a blocking step run in the thread pool whose
+        return value is what the callers get.
+        """
+        future = self.inflight.get(key)
+        if future is None:
+
+            async def job() -> Any:
+                result = await self.submit_render(func, *args)
+                if on_done is not None:
+                    on_done(result)
+                if then is not None:
+                    result = await self.run_io(then, result)
+                return result
+
+            future = asyncio.ensure_future(job())
+            self.inflight[key] = future
+            future.add_done_callback(lambda done: self.forget(key, done))
+        # shield: one cancelled request must not cancel the render for the others
+        return await asyncio.shield(future)
+
+    def forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
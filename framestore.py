@@ -0,0 +1,129 @@
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+from render import FRAME_HEADER, LRUCache, RenderedFrame
+
+# A stored frame file: magic, width, height (uint16), the 16 raw bytes of the
+# frame hash, then the lengths (uint32) of the sections that follow, in order:
+# the binary frame (header + packed bits), the XBM text, the JPEG preview and
+# the gzip-compressed binary frame
+FRAME_FILE_MAGIC = b"AVF1"
+FRAME_FILE_HEADER = struct.Struct("<4sHH16sIIII")
+FRAME_FILE_SUFFIX = ".frame"
+# What a frame hash looks like; anything else (e.g. from a query string) is
+# never used as a file name
+FRAME_HASH = re.compile(r"[0-9a-f]{32}")
+
+
+class StoredFrame:
+    """
+    A frame file mapped into memory. Same fields as a RenderedFrame, but the
+    artifacts are memoryviews into the mapping: serving them copies nothing,
+    and the pages are shared with every other process mapping the file.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+        magic, self.width, self.height, md5, *lengths = FRAME_FILE_HEADER.unpack_from(view)
+        if magic != FRAME_FILE_MAGIC:
+            raise ValueError(f"Not a frame file: {path}")
+        self.md5 = md5.hex()
+        self.timings = {}
+        sections = []
+        offset = FRAME_FILE_HEADER.size
+        for length in lengths:
+            sections.append(view[offset:offset + length])
+            offset += length
+        if offset != len(self.mmap):
+            raise ValueError(f"Truncated frame file: {path}")
+        self.binary, self.xbm, self.jpeg, self.binary_gzip = sections
+        self.bits = self.binary[FRAME_HEADER.size:]
+
+    @property
+    def size(self) -> int:
+        return len(self.mmap)
+
+
+class FrameStore:
+    """
+    Rendered frames shared by all gunicorn workers: one file per frame under
+    `directory`, named by the frame hash. A file is written once (atomically)
+    and never changed, so every worker can map it and serve slices of the
+    mapping while another worker is writing new frames. The OS page cache
+    holds each frame once, however many workers serve it.
+
+    Each worker keeps at most `max_mapped` frames mapped. prune() deletes all
+    but the `max_frames` newest files; workers still mapping a deleted file
+    keep serving it, and a frame that is asked for again is stored again from
+    the artifacts of its upload.
+    """
+
+    def __init__(self, directory: str, max_mapped: int = 256, max_frames: int = 1024) -> None:
+        self.directory = directory
+        self.max_frames = max_frames
+        self.mapped = LRUCache(max_mapped)
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, md5: str) -> str:
+        return os.path.join(self.directory, md5 + FRAME_FILE_SUFFIX)
+
+    def get(self, md5: str) -> StoredFrame | None:
+        """Blocking: the stored frame with hash `md5`, or None if it is not stored (or not a hash)."""
+        if not FRAME_HASH.fullmatch(md5):
+            return None
+        frame = self.mapped.get(md5)
+        if frame is None:
+            try:
+                frame = StoredFrame(self.path(md5))
+            except FileNotFoundError:
+                return None
+            if frame.md5 != md5:
+                raise ValueError(f"Frame file {self.path(md5)} holds frame {frame.md5}")
+            self.mapped.put(md5, frame)
+        return frame
+
+    def put(self, frame: RenderedFrame) -> StoredFrame:
+        """Blocking: store a rendered frame, unless it is stored already, and return it mapped."""
+        stored = self.get(frame.md5)
+        if stored is not None:
+            return stored
+        sections = (frame.binary, frame.xbm.encode("ascii"), frame.jpeg, frame.binary_gzip)
+        header = FRAME_FILE_HEADER.pack(
+            FRAME_FILE_MAGIC, frame.width, frame.height, bytes.fromhex(frame.md5), *map(len, sections)
+        )
+        # Several workers may store the same frame at once: each writes its own
+        # temporary file, and the last rename wins (the bytes are the same)
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(header)
+                for section in sections:
+                    file.write(section)
+            os.replace(tmp_path, self.path(frame.md5))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self.get(frame.md5)
+
+    def prune(self) -> int:
+        """Blocking: delete all but the `max_frames` newest frame files. Returns how many were deleted."""
+        with os.scandir(self.directory) as entries:
+            files = [
+                (entry.stat().st_mtime_ns, entry.path)
+                for entry in entries
+                if entry.name.endswith(FRAME_FILE_SUFFIX)
+            ]
+        files.sort(reverse=True)
+        deleted = 0
+        for _, path in files[self.max_frames:]:
+            try:
+                os.remove(path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
@@ -0,0 +1,158 @@
+import bisect
+import time
+from typing import Callable, Iterable
+
+# Latency buckets in seconds, from a cached poll up to a slow render
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    A metric family in the Prometheus text format. Values are kept per tuple
+    of label values. With `collect`, the values are read from it at scrape
+    time instead: a callable returning {label values: value}.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), collect: Callable | None = None) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+        self.values: dict[tuple, float] = {}
+
+    def samples(self) -> Iterable[str]:
+        values = self.collect() if self.collect is not None else self.values
+        for label_values, value in values.items():
+            yield f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, *label_values) -> None:
+        self.values[label_values] = value
+
+
+class Histogram(Metric):
+    """
+    Observations are counted in the first bucket they fit (a bisect), and only
+    made cumulative when scraped, so observe() stays cheap on hot paths.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.counts: dict[tuple, list] = {}
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, *label_values) -> None:
+        counts = self.counts.get(label_values)
+        if counts is None:
+            counts = self.counts[label_values] = [0] * (len(self.buckets) + 1)
+            self.sums[label_values] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[label_values] += value
+
+    def samples(self) -> Iterable[str]:
+        for label_values, counts in self.counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                labels = _labels(self.labels, label_values, f'le="{_number(float(bound))}"')
+                yield f"{self.name}_bucket{labels} {total}"
+            labels = _labels(self.labels, label_values)
+            yield f"{self.name}_sum{labels} {_number(self.sums[label_values])}"
+            yield f"{self.name}_count{labels} {total}"
+
+
+class Registry:
+    """The metrics of one process, rendered together for a /metrics scrape."""
+
+    def __init__(self) -> None:
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs) -> Counter:
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting and timing every HTTP request by route, labelled
+    with the route's path template (e.g. /archive/{image_id:int}). Requests
+    matching none of `routes` are reported as "other", so random URLs cannot
+    grow the number of series.
+    """
+
+    def __init__(self, app, requests: Counter, latency: Histogram, routes: list) -> None:
+        self.app = app
+        self.requests = requests
+        self.latency = latency
+        # The router stores the matched endpoint in the (shared) scope
+        self.labels = {route.endpoint: route.path for route in routes}
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = self.labels.get(scope.get("endpoint"), "other")
+            self.latency.observe(time.perf_counter() - started, route)
+            self.requests.inc(route, str(status))
@@ -0,0 +1,614 @@
+import fcntl
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from functools import cached_property, lru_cache
+from typing import Callable, Hashable
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont, ImageOps
+
+# E-ink panel resolution of the Heltec Wireless Paper
+FRAME_WIDTH = 256
+FRAME_HEIGHT = 122
+
+# Bump whenever the rendering pipeline changes its output: stored artifacts
+# from older versions are then re-rendered and the devices refresh
+RENDER_VERSION = 2
+
+# Resampling filters selectable by name for the downscale step
+RESAMPLING = {
+    "nearest": Image.Resampling.NEAREST,
+    "box": Image.Resampling.BOX,
+    "bilinear": Image.Resampling.BILINEAR,
+    "hamming": Image.Resampling.HAMMING,
+    "bicubic": Image.Resampling.BICUBIC,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+# How the upload is fitted to the panel:
+#   stretch - resize unproportionally to fill the panel (the original behaviour)
+#   crop    - keep the aspect ratio and cut off what doesn't fit
+#   fit     - keep the aspect ratio and pad with white
+FIT_MODES = ("stretch", "crop", "fit")
+
+# 1-bit conversions:
+#   floyd-steinberg - error diffusion (the original behaviour)
+#   atkinson        - lighter error diffusion, keeps more contrast on e-ink
+#   ordered         - 8x8 Bayer matrix, stable patterns without error "worms"
+#   none            - plain threshold at 50% gray
+DITHERS = ("floyd-steinberg", "atkinson", "ordered", "none")
+
+# Corner of the frame the watermark label is placed in
+WATERMARK_POSITIONS = ("bottom-left", "bottom-right", "top-left", "top-right")
+# Fields available to a profile's watermark_text template, e.g. "{username} {date}"
+WATERMARK_FIELDS = ("username", "caption", "date")
+
+# Panel rotation, in degrees clockwise, mapped to the Pillow transpose
+ROTATIONS = {
+    0: None,
+    90: Image.Transpose.ROTATE_270,
+    180: Image.Transpose.ROTATE_180,
+    270: Image.Transpose.ROTATE_90,
+}
+
+# 8x8 Bayer threshold matrix
+BAYER_8X8 = [
+    [0, 32, 8, 40, 2, 34, 10, 42],
+    [48, 16, 56, 24, 50, 18, 58, 26],
+    [12, 44, 4, 36, 14, 46, 6, 38],
+    [60, 28, 52, 20, 62, 30, 54, 22],
+    [3, 35, 11, 43, 1, 33, 9, 41],
+    [51, 19, 59, 27, 49, 17, 57, 25],
+    [15, 47, 7, 39, 13, 45, 5, 37],
+    [63, 31, 55, 23, 61, 29, 53, 21],
+]
+
+# Artifact file names inside a frame directory
+FRAME_BITS_FILE = "frame.bin"
+FRAME_XBM_FILE = "frame.xbm"
+FRAME_PREVIEW_FILE = "preview.jpg"
+FRAME_META_FILE = "meta.json"
+# Held while a frame directory is being rendered
+FRAME_LOCK_FILE = "render.lock"
+
+# Header of the binary frame: width, height (little-endian uint16) and the
+# 16 raw bytes of the frame hash, followed by the packed bits
+FRAME_HEADER = struct.Struct("<HH16s")
+
+# Header of a frame diff: magic, width, height, base and new frame hashes (16
+# raw bytes each), first and last changed row, and the number of runs. Each run
+# is (skip, length) as uint16 followed by `length` bytes to XOR into the packed
+# bits, `skip` bytes after the end of the previous run.
+FRAME_DIFF_MAGIC = b"AVD1"
+FRAME_DIFF_HEADER = struct.Struct("<4sHH16s16sHHI")
+FRAME_DIFF_RUN = struct.Struct("<HH")
+
+
+@dataclass(frozen=True)
+class DeviceProfile:
+    """How frames are rendered for one kind of board."""
+
+    name: str
+    width: int = FRAME_WIDTH  # panel resolution, as the firmware draws the bits
+    height: int = FRAME_HEIGHT
+    rotation: int = 0  # how the panel is mounted, degrees clockwise
+    dither: str = "floyd-steinberg"
+    invert: bool = False
+    watermark: bool = True
+    watermark_text: str = "{username}"  # template over WATERMARK_FIELDS
+    watermark_position: str = "bottom-left"
+    watermark_font: str = ""  # TrueType/OpenType or .pil font file; "" is Pillow's default font
+    watermark_font_size: int = 0  # 0: the font's default size
+    resample: str = "lanczos"
+    fit: str = "stretch"
+
+    def __post_init__(self) -> None:
+        if self.rotation not in ROTATIONS:
+            raise ValueError(f"Profile {self.name}: rotation must be one of {list(ROTATIONS)}")
+        if self.dither not in DITHERS:
+            raise ValueError(f"Profile {self.name}: dither must be one of {', '.join(DITHERS)}")
+        if self.resample not in RESAMPLING:
+            raise ValueError(f"Profile {self.name}: resample must be one of {', '.join(RESAMPLING)}")
+        if self.fit not in FIT_MODES:
+            raise ValueError(f"Profile {self.name}: fit must be one of {', '.join(FIT_MODES)}")
+        if self.watermark_position not in WATERMARK_POSITIONS:
+            raise ValueError(
+                f"Profile {self.name}: watermark_position must be one of {', '.join(WATERMARK_POSITIONS)}"
+            )
+        try:
+            self.watermark_text.format(**dict.fromkeys(WATERMARK_FIELDS, ""))
+        except (KeyError, IndexError, ValueError):
+            raise ValueError(
+                f"Profile {self.name}: watermark_text may only use {', '.join('{' + f + '}' for f in WATERMARK_FIELDS)}"
+            )
+        if not (0 < self.width <= 0xFFFF and 0 < self.height <= 0xFFFF):
+            raise ValueError(f"Profile {self.name}: invalid size {self.width}x{self.height}")
+
+    @property
+    def view_size(self) -> tuple:
+        """Size of the picture as seen by a viewer, i.e. before rotating it onto the panel."""
+        if self.rotation in (90, 270):
+            return (self.height, self.width)
+        return (self.width, self.height)
+
+    def settings(self) -> dict:
+        """Everything that affects the output, stored with the artifacts."""
+        return asdict(self)
+
+
+@dataclass
+class RenderedFrame:
+    """Everything the device routes serve for one uploaded image."""
+
+    width: int
+    height: int
+    bits: bytes  # packed 1-bit frame, same byte layout as the XBM array
+    xbm: str
+    jpeg: bytes
+    md5: str  # hash of `bits`, changes whenever the served frame changes
+    # Seconds spent per pipeline stage (see render_frame); empty for stored frames
+    timings: dict = field(default_factory=dict, compare=False, repr=False)
+
+    @cached_property
+    def binary(self) -> bytes:
+        """Header + packed bits, for firmware that can copy the frame as-is."""
+        return FRAME_HEADER.pack(self.width, self.height, bytes.fromhex(self.md5)) + self.bits
+
+    @cached_property
+    def binary_gzip(self) -> bytes:
+        """`binary`, gzip-compressed once for clients sending Accept-Encoding: gzip."""
+        return gzip.compress(self.binary, mtime=0)
+
+
+#
+# Watermark: a label (the username by default) in a corner, with a box behind it
+#
+@lru_cache(maxsize=8)
+def load_font(path: str, size: int) -> ImageFont.ImageFont | ImageFont.FreeTypeFont:
+    if not path:
+        return ImageFont.load_default(size) if size else ImageFont.load_default()
+    if path.endswith(".pil"):
+        return ImageFont.load(path)
+    return ImageFont.truetype(path, size or 10)
+
+
+@lru_cache(maxsize=256)
+def rasterize_label(text: str, font_path: str = "", font_size: int = 0) -> tuple:
+    """
+    The watermark label for `text`, drawn once per process and then reused for
+    every frame of that uploader: (label, mask, box size, offset). `label` and
+    `mask` are 1-bit images to paste with the mask; the box is the filled
+    rectangle behind the text, and `offset` is where the label starts relative
+    to the box's top-left corner (the text may stick out of the box).
+    """
+    font = load_font(font_path, font_size)
+    bbox = font.getmask(text).getbbox()
+    text_width, text_height = (bbox[2] - bbox[0], bbox[3] - bbox[1]) if bbox else (0, 0)
+    box_size = (text_width + 4, text_height + 3)
+
+    # Draw on a canvas with room around the box, then crop to what was drawn
+    pad = max(16, text_height)
+    canvas = (box_size[0] + 2 * pad, box_size[1] + 2 * pad)
+    label = Image.new("1", canvas, 0)
+    mask = Image.new("1", canvas, 0)
+    box = (pad, pad, pad + box_size[0] - 1, pad + box_size[1] - 1)
+    ImageDraw.Draw(label).rectangle(box, fill=1)
+    ImageDraw.Draw(mask).rectangle(box, fill=1)
+    ImageDraw.Draw(label).text((pad + 1, pad + 1), text, fill=0, font=font)
+    ImageDraw.Draw(mask).text((pad + 1, pad + 1), text, fill=1, font=font)
+
+    drawn = mask.getbbox()
+    return label.crop(drawn), mask.crop(drawn), box_size, (drawn[0] - pad, drawn[1] - pad)
+
+
+def draw_watermark(
+    img: Image.Image, text: str, position: str = "bottom-left", font_path: str = "", font_size: int = 0
+) -> None:
+    """Paste the cached label for `text` into a corner of a 1-bit frame, in place."""
+    label, mask, (box_width, box_height), (dx, dy) = rasterize_label(text, font_path, font_size)
+    x = img.width - box_width if position.endswith("right") else 0
+    y = img.height - box_height if position.startswith("bottom") else 0
+    img.paste(label, (x + dx, y + dy), mask)
+
+
+def watermark_text(profile: DeviceProfile, label: dict) -> str:
+    """The profile's watermark_text filled with an upload's `label` fields (see WATERMARK_FIELDS)."""
+    return profile.watermark_text.format(**{name: label.get(name, "") for name in WATERMARK_FIELDS})
+
+
+def pack_bits(img: Image.Image) -> bytes:
+    """
+    Pack a 1-bit Pillow image into the byte layout used by the XBM array:
+    pixels in row-major order, 8 per byte, LSB first, black => bit 1.
+
+    Pillow's "1;IR" packer (inverted, reversed bit order) does exactly this in
+    C. It pads every row to a whole byte, while the XBM array is one continuous
+    bit stream, so images whose width isn't a multiple of 8 are first viewed
+    as a single row.
+    """
+    width, height = img.size
+    if width % 8:
+        img = Image.frombytes("1", (width * height, 1), img.tobytes("raw", "L"), "raw", "1;8")
+    return img.tobytes("raw", "1;IR")
+
+
+def generate_xbm_string(img: Image.Image) -> str:
+    """
+    Generate a minimal XBM string from a 1-bit Pillow image.
+    We'll assume the image is exactly 256x122 in '1' mode.
+    """
+    width, height = img.size
+    return format_xbm(pack_bits(img), width, height)
+
+
+def format_xbm(bits: bytes, width: int, height: int) -> str:
+    """Build the XBM text the firmware's parseXBM() expects from packed bits."""
+    # "0x00, 0x01, ..." built by bytes.hex() in one pass instead of per byte
+    xbm_data = "0x" + bits.hex(",").replace(",", ", 0x") if bits else ""
+
+    xbm_str = f"#define wifi_width {width}\n"
+    xbm_str += f"#define wifi_height {height}\n"
+    xbm_str += "static const unsigned char wifi_bits[] = {\n  "
+    xbm_str += xbm_data
+    xbm_str += "\n};\n"
+
+    return xbm_str
+
+
+def load_source(image_path: str, size: tuple, fit: str, resample: str) -> Image.Image:
+    """Decode an upload straight to a grayscale image of `size`."""
+    return fit_source(decode_source(image_path, size), size, fit, resample)
+
+
+def decode_source(image_path: str, size: tuple) -> Image.Image:
+    """
+    Decode an upload to grayscale, at no less than `size`.
+
+    For JPEGs, draft mode lets libjpeg decode at 1/2, 1/4 or 1/8 scale (the
+    smallest one still at least `size`) instead of decoding every megapixel of
+    a full-size Telegram photo just to throw almost all of them away.
+    """
+    with Image.open(image_path) as src:
+        src.draft("L", size)
+        return src.convert("L")
+
+
+def fit_source(img: Image.Image, size: tuple, fit: str, resample: str) -> Image.Image:
+    """Resize a decoded upload to `size` (see FIT_MODES)."""
+    if fit == "crop":
+        return ImageOps.fit(img, size, RESAMPLING[resample])
+    if fit == "fit":
+        return ImageOps.pad(img, size, RESAMPLING[resample], color=255)
+    return img.resize(size, RESAMPLING[resample])
+
+
+@lru_cache(maxsize=8)
+def _bayer_thresholds(size: tuple) -> Image.Image:
+    """The Bayer matrix tiled over `size`, scaled to 0..255 gray levels."""
+    width, height = size
+    rows = [bytes(BAYER_8X8[y % 8][x % 8] * 4 + 2 for x in range(width)) for y in range(8)]
+    return Image.frombytes("L", size, b"".join(rows[y % 8] for y in range(height)))
+
+
+def _atkinson(img: Image.Image) -> Image.Image:
+    """Atkinson error diffusion: spreads 6/8 of the error over six neighbours."""
+    width, height = img.size
+    levels = list(img.tobytes())
+    out = bytearray(width * height)
+    for y in range(height):
+        row = y * width
+        for x in range(width):
+            old = levels[row + x]
+            new = 255 if old >= 128 else 0
+            out[row + x] = new
+            error = (old - new) >> 3
+            if not error:
+                continue
+            if x + 1 < width:
+                levels[row + x + 1] += error
+                if x + 2 < width:
+                    levels[row + x + 2] += error
+            if y + 1 < height:
+                below = row + width + x
+                levels[below] += error
+                if x > 0:
+                    levels[below - 1] += error
+                if x + 1 < width:
+                    levels[below + 1] += error
+                if y + 2 < height:
+                    levels[below + width] += error
+    return Image.frombytes("L", img.size, bytes(out)).convert("1", dither=Image.Dither.NONE)
+
+
+def dither(img: Image.Image, method: str) -> Image.Image:
+    """Convert a grayscale image to 1-bit with one of DITHERS."""
+    if method == "floyd-steinberg":
+        return img.convert("1", dither=Image.FLOYDSTEINBERG)
+    if method == "atkinson":
+        return _atkinson(img)
+    if method == "ordered":
+        # (pixel - threshold) + 128 >= 128  <=>  pixel >= threshold, all in C
+        diff = ImageChops.subtract(img, _bayer_thresholds(img.size), scale=1.0, offset=128)
+        return diff.point(lambda level: 255 if level >= 128 else 0).convert("1", dither=Image.Dither.NONE)
+    return img.convert("1", dither=Image.Dither.NONE)
+
+
+def render_frame(image_path: str, label: dict, profile: DeviceProfile) -> RenderedFrame:
+    """
+    Render an uploaded image into everything a device with `profile` needs:
+      1) Decoding and resizing to the panel size (see load_source and FIT_MODES)
+      2) Converting to pure black & white (see DITHERS)
+      3) Watermarking with the upload's `label` fields (see draw_watermark)
+      4) Packing the bits, building the XBM text and the JPEG preview
+    The seconds spent on each stage are kept in the frame's `timings`.
+    """
+    timings = {}
+    started = time.perf_counter()
+
+    def lap(stage: str) -> None:
+        nonlocal started
+        now = time.perf_counter()
+        timings[stage] = now - started
+        started = now
+
+    img = decode_source(image_path, profile.view_size)
+    lap("decode")
+    img = fit_source(img, profile.view_size, profile.fit, profile.resample)
+    lap("resize")
+
+    # Convert to pure 1-bit black & white
+    img = dither(img, profile.dither)
+    lap("dither")
+
+    # Watermark
+    if profile.watermark:
+        draw_watermark(
+            img,
+            watermark_text(profile, label),
+            profile.watermark_position,
+            profile.watermark_font,
+            profile.watermark_font_size,
+        )
+        lap("watermark")
+
+    if profile.invert:
+        img = ImageChops.invert(img)
+
+    # The preview stays upright; the bits are rotated onto the panel
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format="JPEG")
+
+    transpose = ROTATIONS[profile.rotation]
+    if transpose is not None:
+        img = img.transpose(transpose)
+
+    bits = pack_bits(img)
+    xbm = format_xbm(bits, img.width, img.height)
+    md5 = hashlib.md5(bits).hexdigest()
+    lap("encode")
+
+    return RenderedFrame(
+        width=img.width,
+        height=img.height,
+        bits=bits,
+        xbm=xbm,
+        jpeg=img_byte_arr.getvalue(),
+        md5=md5,
+        timings=timings,
+    )
+
+
+def render_and_save(
+    image_path: str, label: dict, frame_dir: str, source: dict, profile: DeviceProfile
+) -> RenderedFrame:
+    """
+    Render a frame and store its artifacts (module-level, so a process pool can
+    run it). The frame directory is locked meanwhile: if another process is
+    rendering the same frame, this waits for it and returns its artifacts.
+    """
+    os.makedirs(frame_dir, exist_ok=True)
+    with open(os.path.join(frame_dir, FRAME_LOCK_FILE), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        frame = load_frame(frame_dir, source)
+        if frame is not None:
+            return frame
+        frame = render_frame(image_path, label, profile)
+        started = time.perf_counter()
+        save_frame(frame, frame_dir, source)
+        frame.timings["save"] = time.perf_counter() - started
+    return frame
+
+
+def render_thumbnail(image_path: str, thumbnail_path: str, size: int) -> None:
+    """Store a JPEG thumbnail of an upload, at most `size` px on the longer side."""
+    with Image.open(image_path) as src:
+        src.draft("RGB", (size, size))
+        img = src.convert("RGB")
+    img.thumbnail((size, size), Image.Resampling.LANCZOS)
+    jpeg = io.BytesIO()
+    img.save(jpeg, format="JPEG", quality=85)
+    os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+    _write_atomic(thumbnail_path, jpeg.getvalue())
+
+
+def frame_diff(base: RenderedFrame, frame: RenderedFrame) -> bytes | None:
+    """
+    The change from `base` to `frame` as XOR runs over the packed bits (see
+    FRAME_DIFF_HEADER): unchanged stretches are skipped, changed ones carried
+    as XOR bytes. Gaps no longer than a run header are carried rather than
+    skipped. Returns None if the frames differ in size.
+    """
+    if (base.width, base.height) != (frame.width, frame.height):
+        return None
+    size = len(frame.bits)
+    xor = (int.from_bytes(base.bits, "little") ^ int.from_bytes(frame.bits, "little")).to_bytes(size, "little")
+
+    spans = []
+    for match in re.finditer(rb"[^\x00]+", xor):
+        start, end = match.span()
+        if spans and start - spans[-1][1] <= FRAME_DIFF_RUN.size:
+            spans[-1][1] = end
+        else:
+            spans.append([start, end])
+
+    runs = []
+    position = 0
+    for start, end in spans:
+        # Both run fields are uint16: split longer skips and runs
+        while start - position > 0xFFFF:
+            runs.append(FRAME_DIFF_RUN.pack(0xFFFF, 0))
+            position += 0xFFFF
+        while start < end:
+            length = min(end - start, 0xFFFF)
+            runs.append(FRAME_DIFF_RUN.pack(start - position, length) + xor[start : start + length])
+            start = position = start + length
+
+    first_row = last_row = 0
+    if spans:
+        first_row = spans[0][0] * 8 // frame.width
+        last_row = min(frame.height - 1, (spans[-1][1] * 8 - 1) // frame.width)
+    header = FRAME_DIFF_HEADER.pack(
+        FRAME_DIFF_MAGIC,
+        frame.width,
+        frame.height,
+        bytes.fromhex(base.md5),
+        bytes.fromhex(frame.md5),
+        first_row,
+        last_row,
+        len(runs),
+    )
+    return header + b"".join(runs)
+
+
+def apply_frame_diff(bits: bytes, diff: bytes) -> bytes:
+    """Apply a frame_diff to the packed bits of its base frame (what the firmware does)."""
+    *_, count = FRAME_DIFF_HEADER.unpack_from(diff)
+    result = bytearray(bits)
+    offset, position = FRAME_DIFF_HEADER.size, 0
+    for _ in range(count):
+        skip, length = FRAME_DIFF_RUN.unpack_from(diff, offset)
+        offset += FRAME_DIFF_RUN.size
+        position += skip
+        for i in range(length):
+            result[position + i] ^= diff[offset + i]
+        offset += length
+        position += length
+    return bytes(result)
+
+
+def _write_atomic(path: str, data: bytes) -> None:
+    """Write to a temp file and rename, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
+def save_frame(frame: RenderedFrame, frame_dir: str, source: dict) -> None:
+    """
+    Store the artifacts of a rendered frame in `frame_dir`. `source` identifies
+    the upload it was rendered from (mtime, size) and is kept in meta.json, so
+    a replaced upload invalidates the artifacts.
+    """
+    os.makedirs(frame_dir, exist_ok=True)
+    _write_atomic(os.path.join(frame_dir, FRAME_BITS_FILE), frame.bits)
+    _write_atomic(os.path.join(frame_dir, FRAME_XBM_FILE), frame.xbm.encode("ascii"))
+    _write_atomic(os.path.join(frame_dir, FRAME_PREVIEW_FILE), frame.jpeg)
+
+    # meta.json goes last: its presence marks the artifact set as complete
+    meta = {
+        "width": frame.width,
+        "height": frame.height,
+        "md5": frame.md5,
+        "source": source,
+        "render_version": RENDER_VERSION,
+    }
+    _write_atomic(os.path.join(frame_dir, FRAME_META_FILE), json.dumps(meta).encode())
+
+
+def load_frame_meta(frame_dir: str, source: dict) -> dict | None:
+    """
+    Read only meta.json (frame size and hash). Returns None if the frame was
+    never rendered, was rendered from a different version of the upload or by
+    an older version of this pipeline.
+    """
+    try:
+        with open(os.path.join(frame_dir, FRAME_META_FILE), "r") as file:
+            meta = json.load(file)
+    except FileNotFoundError:
+        return None
+    if meta.get("source") != source or meta.get("render_version") != RENDER_VERSION:
+        return None
+    return meta
+
+
+def load_frame(frame_dir: str, source: dict) -> RenderedFrame | None:
+    """Load previously stored artifacts, or return None if they are missing or stale."""
+    meta = load_frame_meta(frame_dir, source)
+    if meta is None:
+        return None
+
+    with open(os.path.join(frame_dir, FRAME_BITS_FILE), "rb") as file:
+        bits = file.read()
+    with open(os.path.join(frame_dir, FRAME_XBM_FILE), "r") as file:
+        xbm = file.read()
+    with open(os.path.join(frame_dir, FRAME_PREVIEW_FILE), "rb") as file:
+        jpeg = file.read()
+
+    return RenderedFrame(
+        width=meta["width"],
+        height=meta["height"],
+        bits=bits,
+        xbm=xbm,
+        jpeg=jpeg,
+        md5=meta["md5"],
+    )
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used cache bounded by a total cost: each value
+    costs `weigh(value)` (1 by default), and the oldest entries are evicted
+    once the total exceeds `capacity`.
+    """
+
+    def __init__(self, capacity: int, weigh: Callable[[object], int] = lambda value: 1) -> None:
+        self.capacity = capacity
+        self.weigh = weigh
+        self.entries: OrderedDict = OrderedDict()
+        self.cost = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value) -> None:
+        cost = self.weigh(value)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.cost -= self.weigh(old)
+            if cost > self.capacity:
+                return
+            self.entries[key] = value
+            self.cost += cost
+            while self.cost > self.capacity:
+                _, evicted = self.entries.popitem(last=False)
+                self.cost -= self.weigh(evicted)
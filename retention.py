@@ -0,0 +1,87 @@
+import os
+import struct
+from typing import Iterator
+
+# Pack file: retired originals appended one after another, each record a header
+# ("AVP1", little-endian uint32 data length, uint16 name length), the UTF-8
+# filename and the JPEG bytes. The catalog keeps the offset and length of each
+# record's data; the headers make the pack readable without it (see read_pack_index).
+PACK_MAGIC = b"AVP1"
+PACK_RECORD = struct.Struct("<4sIH")
+
+# What happens to the originals of expired uploads
+RETENTION_MODES = ("pack", "delete")
+
+
+def select_expired(
+    images: list,
+    max_age: float = 0,
+    max_count: int = 0,
+    max_bytes: int = 0,
+    keep: int = 1,
+    now: float = 0,
+) -> list:
+    """
+    The images whose originals a retention policy retires. `images` are
+    (mtime, size, filename) tuples, newest first. An image expires if it is
+    older than `max_age` seconds, beyond the newest `max_count`, or beyond
+    `max_bytes` counted from the newest; 0 disables a limit. The newest `keep`
+    images never expire. Returns the expired tuples, newest first.
+    """
+    expired = []
+    total = 0
+    for index, (mtime, size, filename) in enumerate(images):
+        total += size
+        if index < keep:
+            continue
+        if (
+            (max_age and now - mtime > max_age)
+            or (max_count and index >= max_count)
+            or (max_bytes and total > max_bytes)
+        ):
+            expired.append((mtime, size, filename))
+    return expired
+
+
+def append_to_pack(pack_path: str, filename: str, data: bytes) -> int:
+    """
+    Append a record to the pack and sync it to disk. Returns the offset of
+    `data` in the pack. Only one process may append at a time.
+    """
+    name = filename.encode("utf-8")
+    with open(pack_path, "ab") as pack:
+        offset = pack.tell()
+        pack.write(PACK_RECORD.pack(PACK_MAGIC, len(data), len(name)) + name + data)
+        pack.flush()
+        os.fsync(pack.fileno())
+    return offset + PACK_RECORD.size + len(name)
+
+
+def read_from_pack(pack_path: str, offset: int, length: int) -> bytes:
+    with open(pack_path, "rb") as pack:
+        pack.seek(offset)
+        data = pack.read(length)
+    if len(data) != length:
+        raise ValueError(f"Truncated record at {offset} in {pack_path}")
+    return data
+
+
+def read_pack_index(pack_path: str) -> Iterator[tuple]:
+    """
+    Walk the record headers of a pack, yielding (filename, offset, length) per
+    record. A torn record at the end (an append cut short) is ignored.
+    """
+    end = os.path.getsize(pack_path)
+    with open(pack_path, "rb") as pack:
+        position = 0
+        while position + PACK_RECORD.size <= end:
+            magic, length, name_length = PACK_RECORD.unpack(pack.read(PACK_RECORD.size))
+            if magic != PACK_MAGIC:
+                raise ValueError(f"Corrupt record at {position} in {pack_path}")
+            offset = position + PACK_RECORD.size + name_length
+            if offset + length > end:
+                return
+            filename = pack.read(name_length).decode("utf-8")
+            yield filename, offset, length
+            position = offset + length
+            pack.seek(position)
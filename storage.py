@@ -0,0 +1,408 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Schema migrations, applied in order. PRAGMA user_version records how many
+# have run, so add new statements at the end and never edit old ones.
+MIGRATIONS = [
+    """
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        registered_at TEXT NOT NULL
+    );
+    CREATE TABLE networks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ssid TEXT NOT NULL,
+        password TEXT NOT NULL,
+        added_at TEXT NOT NULL
+    );
+    CREATE INDEX networks_ssid ON networks (ssid);
+    CREATE TABLE images (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        filename TEXT NOT NULL UNIQUE,
+        user_id INTEGER,
+        username TEXT NOT NULL,
+        caption TEXT NOT NULL,
+        uploaded_at TEXT NOT NULL
+    );
+    CREATE INDEX images_uploaded_at ON images (uploaded_at);
+    CREATE TABLE settings (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """,
+    """
+    ALTER TABLE images ADD COLUMN file_unique_id TEXT;
+    ALTER TABLE images ADD COLUMN content_hash TEXT;
+    CREATE UNIQUE INDEX images_file_unique_id ON images (file_unique_id);
+    CREATE UNIQUE INDEX images_content_hash ON images (content_hash);
+    """,
+    """
+    CREATE TABLE updates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        data TEXT NOT NULL,
+        received_at TEXT NOT NULL
+    );
+    """,
+    """
+    CREATE INDEX images_username ON images (username, uploaded_at);
+    """,
+    """
+    ALTER TABLE images ADD COLUMN stored TEXT NOT NULL DEFAULT 'file';
+    ALTER TABLE images ADD COLUMN pack_offset INTEGER;
+    ALTER TABLE images ADD COLUMN pack_length INTEGER;
+    """,
+    """
+    CREATE TABLE devices (
+        device_id TEXT PRIMARY KEY,
+        firmware TEXT,
+        md5 TEXT,
+        first_seen TEXT NOT NULL,
+        last_seen TEXT NOT NULL
+    );
+    """,
+    """
+    ALTER TABLE networks ADD COLUMN version INTEGER NOT NULL DEFAULT 0;
+    DELETE FROM networks WHERE id NOT IN (SELECT max(id) FROM networks GROUP BY ssid);
+    UPDATE networks SET version = id;
+    DROP INDEX networks_ssid;
+    CREATE UNIQUE INDEX networks_ssid ON networks (ssid);
+    CREATE INDEX networks_version ON networks (version);
+    """,
+]
+
+# Add a Wi-Fi network, or update the password of a known SSID. Either way the
+# row gets the next Wi-Fi book version; sharing a network again unchanged does nothing.
+NETWORK_UPSERT = (
+    "INSERT INTO networks (ssid, password, added_at, version)"
+    " VALUES (?, ?, ?, (SELECT coalesce(max(version), 0) + 1 FROM networks))"
+    " ON CONFLICT (ssid) DO UPDATE SET password = excluded.password, version = excluded.version"
+    " WHERE password != excluded.password"
+)
+
+# Catalog columns returned for an image. `stored` says where the original is:
+# 'file' (in the image directory), 'pack' (at pack_offset in the retention
+# pack) or 'deleted'.
+IMAGE_COLUMNS = "id, filename, username, caption, uploaded_at, stored, pack_offset, pack_length"
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+class Storage:
+    """
+    SQLite store for users, Wi-Fi networks, uploaded images and relayed
+    Telegram updates.
+
+    The database runs in WAL mode, so readers never block the writer and
+    several gunicorn workers can share it safely. Every method is blocking:
+    call them from a thread (run_in_threadpool), not from the event loop.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.local = threading.local()
+        self.connect().execute("PRAGMA journal_mode=WAL")
+        self.migrate()
+
+    def connect(self) -> sqlite3.Connection:
+        """One connection per thread, reused across calls."""
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def migrate(self) -> None:
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            for statements in MIGRATIONS[version:]:
+                for statement in statements.split(";"):
+                    if statement.strip():
+                        db.execute(statement)
+            db.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def import_json(self, user_data_file: str, networks_file: str) -> None:
+        """
+        One-time migration from the old user_data.json / networks.json files.
+        The files are left in place; a settings flag prevents a second import.
+        """
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            done = db.execute("SELECT 1 FROM settings WHERE key = 'json_imported'").fetchone()
+            if done is None:
+                users, networks = 0, 0
+                if os.path.exists(user_data_file):
+                    with open(user_data_file, "r") as file:
+                        for user_id in json.load(file):
+                            users += db.execute(
+                                "INSERT OR IGNORE INTO users (user_id, registered_at) VALUES (?, ?)",
+                                (user_id, _now()),
+                            ).rowcount
+                if os.path.exists(networks_file):
+                    with open(networks_file, "r") as file:
+                        for network in json.load(file):
+                            db.execute(NETWORK_UPSERT, (network["ssid"], network["password"], _now()))
+                            networks += 1
+                db.execute("INSERT INTO settings (key, value) VALUES ('json_imported', ?)", (_now(),))
+                logger.info(f"Imported {users} users and {networks} networks from JSON files")
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    #
+    # Users
+    #
+    def register_user(self, user_id: int) -> bool:
+        """Register a user. Returns False if they were already registered."""
+        cursor = self.connect().execute(
+            "INSERT OR IGNORE INTO users (user_id, registered_at) VALUES (?, ?)",
+            (user_id, _now()),
+        )
+        return cursor.rowcount > 0
+
+    def remove_user(self, user_id: int) -> None:
+        self.connect().execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+
+    def get_all_user_ids(self) -> list:
+        rows = self.connect().execute("SELECT user_id FROM users")
+        return [row["user_id"] for row in rows]
+
+    #
+    # Wi-Fi networks
+    #
+    def add_network(self, ssid: str, password: str) -> None:
+        self.connect().execute(NETWORK_UPSERT, (ssid, password, _now()))
+
+    def get_networks(self) -> list:
+        """
+        All networks in the order they were first shared, as the firmware
+        expects them, each with the Wi-Fi book version it last changed in.
+        """
+        rows = self.connect().execute("SELECT ssid, password, version FROM networks ORDER BY id")
+        return [dict(row) for row in rows]
+
+    def get_networks_version(self) -> int:
+        """The Wi-Fi book version: it grows whenever a network is added or changed."""
+        return self.connect().execute("SELECT coalesce(max(version), 0) FROM networks").fetchone()[0]
+
+    #
+    # Images
+    #
+    def add_image(
+        self,
+        filename: str,
+        user_id: int | None,
+        username: str,
+        caption: str,
+        file_unique_id: str | None = None,
+        content_hash: str | None = None,
+    ) -> str | None:
+        """
+        Record an upload under `filename`, or, if another image already has
+        that name (e.g. photos of one album, sent in the same second), under
+        the first free `<stem>_<n><ext>`. Returns the filename recorded, or
+        None, recording nothing, if an image with the same Telegram
+        file_unique_id or content hash is already stored.
+        """
+        db = self.connect()
+        stem, ext = os.path.splitext(filename)
+        n = 1
+        while True:
+            try:
+                db.execute(
+                    "INSERT INTO images (filename, user_id, username, caption, uploaded_at,"
+                    " file_unique_id, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (filename, user_id, username, caption, _now(), file_unique_id, content_hash),
+                )
+                return filename
+            except sqlite3.IntegrityError:
+                duplicate = db.execute(
+                    "SELECT 1 FROM images WHERE file_unique_id = ? OR content_hash = ?",
+                    (file_unique_id, content_hash),
+                ).fetchone()
+                if duplicate is not None:
+                    return None
+            n += 1
+            filename = f"{stem}_{n}{ext}"
+
+    def has_image(self, file_unique_id: str) -> bool:
+        row = self.connect().execute(
+            "SELECT 1 FROM images WHERE file_unique_id = ?", (file_unique_id,)
+        ).fetchone()
+        return row is not None
+
+    def add_existing_images(self, images: list) -> int:
+        """
+        Catalog images found in the image directory without a row (copied in by
+        hand, or uploaded before the catalog existed). `images` are dicts with
+        filename, username, caption and uploaded_at. Returns how many were added.
+        """
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            added = 0
+            for image in images:
+                added += db.execute(
+                    "INSERT OR IGNORE INTO images (filename, username, caption, uploaded_at)"
+                    " VALUES (:filename, :username, :caption, :uploaded_at)",
+                    image,
+                ).rowcount
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return added
+
+    def get_image_filenames(self) -> set:
+        return {row["filename"] for row in self.connect().execute("SELECT filename FROM images")}
+
+    def get_image(self, image_id: int) -> dict | None:
+        row = self.connect().execute(
+            f"SELECT {IMAGE_COLUMNS} FROM images WHERE id = ?", (image_id,)
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def get_image_by_filename(self, filename: str) -> dict | None:
+        row = self.connect().execute(
+            f"SELECT {IMAGE_COLUMNS} FROM images WHERE filename = ?",
+            (filename,),
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    def list_images(self, offset: int, limit: int, username: str | None = None) -> tuple:
+        """One page of the catalog, newest first. Returns (total count, list of image dicts)."""
+        where, args = ("WHERE username = ?", (username,)) if username else ("", ())
+        db = self.connect()
+        total = db.execute(f"SELECT COUNT(*) FROM images {where}", args).fetchone()[0]
+        rows = db.execute(
+            f"SELECT {IMAGE_COLUMNS} FROM images {where}"
+            " ORDER BY uploaded_at DESC, id DESC LIMIT ? OFFSET ?",
+            (*args, limit, offset),
+        )
+        return total, [dict(row) for row in rows]
+
+    def retire_image(
+        self, filename: str, stored: str, pack_offset: int | None = None, pack_length: int | None = None
+    ) -> None:
+        """Record that the original of an image was packed or deleted (see `stored`)."""
+        self.connect().execute(
+            "UPDATE images SET stored = ?, pack_offset = ?, pack_length = ? WHERE filename = ?",
+            (stored, pack_offset, pack_length, filename),
+        )
+
+    def get_packed_filenames(self) -> set:
+        return {
+            row["filename"]
+            for row in self.connect().execute("SELECT filename FROM images WHERE stored = 'pack'")
+        }
+
+    def restore_packed_images(self, images: list) -> int:
+        """
+        Catalog originals found in the pack file as packed, adding rows that
+        are missing. `images` are dicts with filename, username, caption,
+        uploaded_at, pack_offset and pack_length. Returns how many were restored.
+        """
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for image in images:
+                db.execute(
+                    "INSERT OR IGNORE INTO images (filename, username, caption, uploaded_at)"
+                    " VALUES (:filename, :username, :caption, :uploaded_at)",
+                    image,
+                )
+                db.execute(
+                    "UPDATE images SET stored = 'pack', pack_offset = :pack_offset, pack_length = :pack_length"
+                    " WHERE filename = :filename",
+                    image,
+                )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return len(images)
+
+    #
+    # Devices (see devices.DeviceRegistry), written in batches
+    #
+    def save_devices(self, devices: list, max_devices: int) -> None:
+        """
+        Store a batch of devices (dicts with device_id, firmware, md5 and
+        last_seen as Unix time) in one transaction. Workers flush on their own,
+        so a row is only updated from a batch that saw the device more recently.
+        Only the `max_devices` most recently seen devices are kept.
+        """
+        rows = [
+            {**device, "last_seen": datetime.fromtimestamp(device["last_seen"]).isoformat(timespec="seconds")}
+            for device in devices
+        ]
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                "INSERT INTO devices (device_id, firmware, md5, first_seen, last_seen)"
+                " VALUES (:device_id, :firmware, :md5, :last_seen, :last_seen)"
+                " ON CONFLICT (device_id) DO UPDATE SET"
+                " firmware = CASE WHEN excluded.last_seen >= last_seen"
+                " THEN coalesce(excluded.firmware, firmware) ELSE firmware END,"
+                " md5 = CASE WHEN excluded.last_seen >= last_seen THEN coalesce(excluded.md5, md5) ELSE md5 END,"
+                " last_seen = max(last_seen, excluded.last_seen)",
+                rows,
+            )
+            db.execute(
+                "DELETE FROM devices WHERE device_id NOT IN"
+                " (SELECT device_id FROM devices ORDER BY last_seen DESC LIMIT ?)",
+                (max_devices,),
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def get_devices(self) -> list:
+        """All stored devices, most recently seen first, with last_seen as Unix time."""
+        rows = self.connect().execute(
+            "SELECT device_id, firmware, md5, first_seen, last_seen FROM devices ORDER BY last_seen DESC"
+        )
+        return [
+            {**dict(row), "last_seen": datetime.fromisoformat(row["last_seen"]).timestamp()} for row in rows
+        ]
+
+    #
+    # Telegram updates received by workers that do not run the bot
+    #
+    def add_update(self, data: str) -> None:
+        self.connect().execute(
+            "INSERT INTO updates (data, received_at) VALUES (?, ?)", (data, _now())
+        )
+
+    def take_updates(self, limit: int = 100) -> list:
+        """Remove and return the oldest stored updates, decoded, in arrival order."""
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute("SELECT id, data FROM updates ORDER BY id LIMIT ?", (limit,)).fetchall()
+            if rows:
+                db.execute("DELETE FROM updates WHERE id <= ?", (rows[-1]["id"],))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return [json.loads(row["data"]) for row in rows]